@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+"""Compare one-shot `requests.request` calls against the pooled `Client` session.
+
+Usage: python3 -m bench.client_pool [num_requests]
+"""
+
+import sys
+import time
+import requests
+from bench.fake_es import FakeES
+from lib.es.client import Client
+
+
+def unpooled(url, num):
+    for _ in range(num):
+        requests.request("get", url+"_cluster/health").json()
+
+
+def pooled(url, num):
+    client = Client(url)
+    for _ in range(num):
+        client.do_get("_cluster/health")
+    client.close()
+
+
+def main():
+    num = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    with FakeES() as fake:
+        print("{:<10} {:>10} {:>10} {:>12}".format("mode", "requests", "req/s", "handshakes"))
+        for name, func in (("before", unpooled), ("after", pooled)):
+            fake.reset_counters()
+            start = time.perf_counter()
+            func(fake.url, num)
+            elapsed = time.perf_counter() - start
+            print("{:<10} {:>10} {:>10.0f} {:>12}".format(
+                name, fake.requests, num / elapsed, fake.connections))
+
+
+if __name__ == '__main__':
+    main()
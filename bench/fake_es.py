@@ -0,0 +1,439 @@
+"""Local in-process stand-in for the parts of the Elasticsearch API used by esctl"""
+
+import fnmatch
+import gzip
+import json
+import threading
+import time
+import uuid
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+ES_VERSION = "7.16.0"
+# Start time of the first pre-existing snapshot, they are taken an hour apart
+FIRST_SNAPSHOT_MILLIS = 1600000000000
+
+
+class FakeES:
+    """Threaded HTTP/1.1 server keeping just enough state to answer the health, settings, cat,
+    stats, snapshot, restore, recovery and index close calls made by esctl. Counts accepted
+    connections (i.e. handshakes) and requests served.
+
+    Every response is delayed by `latency` seconds, snapshots take `snapshot_duration` seconds to
+    complete, and after a restore the cluster stays red for `restore_duration` seconds. Each index
+    has `shards` primaries, plus a replica each if there are several `nodes`, spread round robin"""
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, indices=5, snapshots=10,
+                 snapshot_duration=0.5, restore_duration=0.0, version=ES_VERSION, nodes=1,
+                 shards=1):
+        self.connections = 0
+        self.requests = 0
+        self.latency = latency
+        self.snapshot_duration = snapshot_duration
+        self.restore_duration = restore_duration
+        self.version = version
+        self.indices = {}
+        for i in range(indices):
+            self.indices["index-{:05d}".format(i)] = dict(
+                status="open", uuid=uuid.uuid4().hex, docs=100 * i, size=1000 * (i + 1),
+                seq_no=100 * i - 1, settings={})
+        self.nodes = ["node-{}".format(i) for i in range(nodes)]
+        self.heap = dict((node, 50) for node in self.nodes)
+        self.disk = dict((node, 40) for node in self.nodes)
+        self.shards = []
+        for i, name in enumerate(self.indices):
+            for shard in range(shards):
+                for replica in range(2 if nodes > 1 else 1):
+                    node = self.nodes[(i * shards + shard + replica) % nodes]
+                    self.shards.append(dict(index=name, shard=shard, primary=not replica,
+                                            node=node))
+        self.repos = {}
+        self.snapshots = []
+        self.settings = {"persistent": {}, "transient": {}}
+        self._restore_started = 0
+        self._started = time.time()
+        self._lock = threading.Lock()
+        for i in range(snapshots):
+            self._add_snapshot("snapshot-{:05d}".format(i), list(self.indices),
+                               FIRST_SNAPSHOT_MILLIS + i * 3600000, "SUCCESS")
+        self._server = ThreadingHTTPServer((host, port), _mk_handler(self))
+        self._server.daemon_threads = True
+        self._thread = None
+
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return "http://{}:{}/".format(host, port)
+
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+    def reset_counters(self):
+        with self._lock:
+            self.connections = 0
+            self.requests = 0
+
+
+    def count(self, attr):
+        with self._lock:
+            setattr(self, attr, getattr(self, attr) + 1)
+
+
+    def write(self, index, docs=1):
+        """Index `docs` more documents into an index"""
+        with self._lock:
+            self.indices[index]["docs"] += docs
+            self.indices[index]["size"] += 10 * docs
+            self.indices[index]["seq_no"] += docs
+
+
+    def handle(self, method, path, query=None, body=None):
+        """Returns (status, body) for the given request"""
+        query = query or {}
+        parts = [p for p in path.split("/") if p]
+        with self._lock:
+            if not parts:
+                return 200, {"cluster_name": "fake", "version": {"number": self.version}}
+            if parts[0] == "_cluster" and parts[1:] == ["health"]:
+                return self._health(query)
+            if parts[0] == "_cluster" and parts[1:] == ["settings"]:
+                return self._cluster_settings(method, body)
+            if parts[0] == "_cat" and len(parts) == 2:
+                return self._cat(parts[1])
+            if parts[0] == "_snapshot":
+                return self._snapshot(method, parts[1:], query, body)
+            if parts[0] == "_nodes" and parts[1:2] == ["stats"]:
+                return 200, self._nodes_stats()
+            if parts[0] == "_stats":
+                return 200, self._stats()
+            if parts[0] == "_recovery":
+                return 200, self._recovery(query.get("active_only") == "true")
+            if len(parts) in (2, 3) and parts[1] == "_settings":
+                keys = parts[2].split(",") if len(parts) == 3 else None
+                return self._index_settings(method, parts[0].split(","), body, keys)
+            if len(parts) == 2 and parts[1] == "_close":
+                for name in parts[0].split(","):
+                    if name in self.indices:
+                        self.indices[name]["status"] = "close"
+                return 200, {"acknowledged": True}
+        return 404, {"error": "no handler for {} {}".format(method, path), "status": 404}
+
+
+    def _health(self, query):
+        """Red while a restore is running, honours wait_for_status by holding the request"""
+        left = self._restore_started + self.restore_duration - time.time()
+        if left > 0 and "wait_for_status" in query:
+            timeout = float(query.get("timeout", "30s").rstrip("s"))
+            self._lock.release()
+            try:
+                time.sleep(min(timeout, left))
+            finally:
+                self._lock.acquire()
+            left -= timeout
+        status = "red" if left > 0 else "green"
+        return (408 if left > 0 and "wait_for_status" in query else 200), dict(
+            cluster_name="fake", status=status, timed_out=left > 0, number_of_nodes=1,
+            number_of_data_nodes=1, unassigned_shards=len(self.indices) if left > 0 else 0,
+            delayed_unassigned_shards=0, number_of_pending_tasks=0)
+
+
+    def _cluster_settings(self, method, body):
+        if method == "GET":
+            return 200, self.settings
+        for kind in ("persistent", "transient"):
+            for key, value in (body or {}).get(kind, {}).items():
+                if value is None:
+                    self.settings[kind].pop(key, None)
+                else:
+                    self.settings[kind][key] = value
+        return 200, dict(acknowledged=True, **(body or {}))
+
+
+    def _cat(self, what):
+        if what == "health":
+            return 200, [{"cluster": "fake", "status": "green", "node.total": "1"}]
+        if what == "indices":
+            return 200, [{"index": name, "status": index["status"], "health": "green",
+                          "uuid": index["uuid"], "docs.count": str(index["docs"]),
+                          "docs.deleted": "0",
+                          "pri.store.size": str(index["size"]),
+                          "store.size": str(index["size"] * 2)}
+                         for name, index in self.indices.items()]
+        if what == "shards":
+            return 200, [{"index": shard["index"], "shard": str(shard["shard"]),
+                          "prirep": "p" if shard["primary"] else "r",
+                          "state": "STARTED" if shard["node"] else "UNASSIGNED",
+                          "store": str(self._shard_size(shard)) if shard["node"] else None,
+                          "node": shard["node"]}
+                         for shard in self.shards]
+        if what == "allocation":
+            return 200, [{"node": node, "shards": str(sum(s["node"] == node for s in self.shards)),
+                          "disk.percent": str(self.disk[node])} for node in self.nodes]
+        return 404, {"error": "unknown cat API {}".format(what)}
+
+
+    def _shard_size(self, shard):
+        index = self.indices[shard["index"]]
+        return index["size"] // max(1, sum(s["index"] == shard["index"] and s["primary"]
+                                          for s in self.shards))
+
+
+    def _nodes_stats(self):
+        """Counters growing at a steady rate per node, later nodes are busier"""
+        now = time.time()
+        nodes = {}
+        for i, node in enumerate(self.nodes):
+            grown = int((now - self._started) * 100 * (i + 1))
+            nodes["id-" + node] = {
+                "name": node,
+                "timestamp": int(now * 1000),
+                "indices": {"indexing": {"index_total": 10 * grown},
+                            "search": {"query_total": grown},
+                            "merges": {"total": grown // 100}},
+                "jvm": {"mem": {"heap_used_percent": self.heap[node]},
+                        "gc": {"collectors": {"young": {"collection_time_in_millis": grown // 10},
+                                              "old": {"collection_time_in_millis": 0}}}},
+                "thread_pool": {"write": {"rejected": grown // 50}, "search": {"rejected": 0}},
+                "fs": {"io_stats": {"total": {"read_kilobytes": grown,
+                                              "write_kilobytes": 5 * grown}}},
+            }
+        return {"nodes": nodes}
+
+
+    def _stats(self):
+        """Shard level stats, with only the sequence numbers filled in"""
+        return {"indices": {name: {"shards": {"0": [{"seq_no": {"max_seq_no": index["seq_no"]}}]}}
+                            for name, index in self.indices.items()
+                            if index["status"] == "open"}}
+
+
+    def _snapshot(self, method, parts, query, body):
+        if not parts:
+            return 200, self.repos
+        repo = parts[0]
+        if len(parts) == 1:
+            if method == "PUT":
+                self.repos[repo] = body
+                return 200, {"acknowledged": True}
+            if repo not in self.repos:
+                return 404, {"error": "repository_missing_exception", "status": 404}
+            return 200, {repo: self.repos[repo]}
+        if repo not in self.repos:
+            return 404, {"error": "repository_missing_exception", "status": 404}
+        if parts[1] == "_verify":
+            return 200, {"nodes": {"node-1": {"name": "node-1"}}}
+        names = parts[1].split(",")
+        action = parts[2] if len(parts) > 2 else None
+        if action == "_restore":
+            self._restore_started = time.time()
+            restored = [s["indices"] for s in self.snapshots if s["snapshot"] == names[0]]
+            if body and body.get("indices"):
+                restored = [body["indices"].split(",")]
+            for name in restored[0] if restored else []:
+                if name in self.indices:
+                    self.indices[name]["status"] = "open"
+            return 200, {"accepted": True}
+        if action == "_status":
+            return 200, {"snapshots": [self._snapshot_status(s) for s in self.snapshots
+                                       if s["snapshot"] in names]}
+        if method == "PUT":
+            indices = list(self.indices)
+            if body and body.get("indices"):
+                indices = body["indices"]
+                if isinstance(indices, str):
+                    indices = indices.split(",")
+            snapshot = self._add_snapshot(names[0], indices, int(time.time() * 1000),
+                                          "IN_PROGRESS")
+            if query.get("wait_for_completion") != "true":
+                return 200, {"accepted": True}
+            self._lock.release()
+            try:
+                time.sleep(self.snapshot_duration)
+            finally:
+                self._lock.acquire()
+            info = self._public(snapshot)
+            info["shards"] = dict(total=len(indices), failed=0, successful=len(indices))
+            return 200, {"snapshot": info}
+        if method == "DELETE":
+            before = len(self.snapshots)
+            self.snapshots = [s for s in self.snapshots if s["snapshot"] not in names]
+            if len(self.snapshots) == before:
+                return 404, {"error": "snapshot_missing_exception", "status": 404}
+            return 200, {"acknowledged": True}
+        return self._list_snapshots(names, query)
+
+
+    def _list_snapshots(self, names, query):
+        if names in (["_all"], ["*"]):
+            snapshots = [self._public(s) for s in self.snapshots]
+        else:
+            snapshots = [self._public(s) for s in self.snapshots
+                         if any(fnmatch.fnmatchcase(s["snapshot"], name) for name in names)]
+            if not snapshots and not any("*" in name for name in names):
+                return 404, {"error": "snapshot_missing_exception", "status": 404}
+        res = {}
+        if "sort" in query:
+            descending = query.get("order") == "desc"
+            sort_key = lambda s: (s["start_time_in_millis"], s["snapshot"])
+            snapshots.sort(key=sort_key, reverse=descending)
+            if "after" in query:
+                millis, name = query["after"].split("|", 1)
+                after = (int(millis), name)
+                snapshots = [s for s in snapshots
+                             if (sort_key(s) < after if descending else sort_key(s) > after)]
+            size = int(query.get("size", 0))
+            if size and len(snapshots) > size:
+                snapshots = snapshots[:size]
+                res["next"] = "{}|{}".format(snapshots[-1]["start_time_in_millis"],
+                                             snapshots[-1]["snapshot"])
+        res["snapshots"] = snapshots
+        if "filter_path" in query:
+            paths = query["filter_path"].split(",")
+            keys = [p.split(".", 1)[1] for p in paths if p.startswith("snapshots.")]
+            res["snapshots"] = [{k: s[k] for k in keys if k in s} for s in snapshots]
+            if "next" not in paths:
+                res.pop("next", None)
+            if not res["snapshots"]:
+                res.pop("snapshots")
+        return 200, res
+
+
+    def _add_snapshot(self, name, indices, start_millis, state):
+        snapshot = dict(snapshot=name, uuid=uuid.uuid4().hex, version=self.version,
+                        indices=list(indices), state=state,
+                        start_time=_iso(start_millis), start_time_in_millis=start_millis,
+                        end_time=_iso(start_millis + 1000), end_time_in_millis=start_millis + 1000,
+                        created=time.time())
+        self.snapshots.append(snapshot)
+        return snapshot
+
+
+    def _progress(self, snapshot):
+        """Fraction of the snapshot done"""
+        if snapshot["state"] != "IN_PROGRESS":
+            return 1.0
+        done = min(1.0, (time.time() - snapshot["created"]) / (self.snapshot_duration or 1))
+        if done >= 1.0:
+            snapshot["state"] = "SUCCESS"
+        return done
+
+
+    def _public(self, snapshot):
+        self._progress(snapshot)
+        return {k: v for k, v in snapshot.items() if k != "created"}
+
+
+    def _snapshot_status(self, snapshot):
+        done = self._progress(snapshot)
+        elapsed = int((time.time() - snapshot["created"]) * 1000)
+        indices = {}
+        processed = total = finished = 0
+        for i, name in enumerate(snapshot["indices"]):
+            size = 10 ** 7 * (i + 1)
+            stats = {"processed": {"size_in_bytes": int(size * done)},
+                     "total": {"size_in_bytes": size}, "time_in_millis": elapsed}
+            stage = "DONE" if done >= 1.0 else "STARTED"
+            finished += stage == "DONE"
+            processed += int(size * done)
+            total += size
+            indices[name] = {"stats": stats, "shards": {"0": dict(
+                stage=stage, node="node-{}".format(i % 2), stats=stats)}}
+        return dict(snapshot=snapshot["snapshot"], state=snapshot["state"], indices=indices,
+                    shards_stats=dict(done=finished, total=len(indices), failed=0),
+                    stats={"processed": {"size_in_bytes": processed},
+                           "total": {"size_in_bytes": total}})
+
+
+    def _recovery(self, active_only=True):
+        """Shards of the last restore, later indices recover faster. Each index has a replica
+        recovering from its primary as well"""
+        out = {}
+        elapsed = time.time() - self._restore_started
+        if not self.restore_duration or not self._restore_started:
+            return out
+        for i, name in enumerate(self.indices):
+            done = min(1.0, elapsed / self.restore_duration * (1 + i * 0.3))
+            if done >= 1.0 and active_only:
+                continue
+            size = 10 ** 8 * (i + 1)
+            out[name] = {"shards": [{
+                "id": 0, "type": recovery_type, "stage": "DONE" if done >= 1.0 else "INDEX",
+                "start_time_in_millis": int(self._restore_started * 1000),
+                "target": {"name": "node-{}".format((i + (recovery_type == "PEER")) % 2)},
+                "index": {"size": {"total_in_bytes": size,
+                                   "recovered_in_bytes": int(size * done)},
+                          "files": {"total": 100, "recovered": int(100 * done)}}}
+                for recovery_type in ("SNAPSHOT", "PEER")]}
+        return out
+
+
+    def _index_settings(self, method, names, body, keys=None):
+        """Flat settings of indices, only the given `keys` if any"""
+        names = [n for n in names if n in self.indices]
+        if method == "PUT":
+            for name in names:
+                self.indices[name]["settings"].update(body or {})
+            return 200, {"acknowledged": True}
+        return 200, {name: {"settings": {k: v for k, v in self.indices[name]["settings"].items()
+                                         if v is not None and (keys is None or k in keys)}}
+                     for name in names}
+
+
+    def __enter__(self):
+        return self.start()
+
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def _iso(millis):
+    return time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(millis / 1000))
+
+
+def _mk_handler(fake):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def setup(self):
+            fake.count("connections")
+            super().setup()
+
+        def log_message(self, *args):
+            pass
+
+        def _respond(self):
+            fake.count("requests")
+            url = urlparse(self.path)
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length).decode()) if length else None
+            if fake.latency:
+                time.sleep(fake.latency)
+            status, body = fake.handle(self.command, url.path, query, body)
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            if "gzip" in self.headers.get("Accept-Encoding", ""):
+                data = gzip.compress(data)
+                self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = do_PUT = do_POST = do_DELETE = do_HEAD = _respond
+
+    return Handler
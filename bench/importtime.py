@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+"""Check that `main.py --help` stays cheap to start: heavy modules must not be imported, and the
+cumulative import time of the CLI must stay within a budget. Exits non-zero otherwise.
+
+Usage: python3 -m bench.importtime [--budget MILLISECONDS] [--runs N]
+"""
+
+import os
+import sys
+import argparse
+import subprocess
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Cumulative import time of lib.cli.app, in milliseconds
+DEFAULT_BUDGET = 50
+# Modules only needed once a command is dispatched
+FORBIDDEN = ["requests", "urllib3", "asyncio", "retrying", "uuid", "lib.es.client",
+             "lib.cli.snapper", "lib.cli.cluster"]
+
+
+def import_times(args):
+    """Run main.py with -X importtime, returns a dict of module to cumulative microseconds"""
+    cmd = [sys.executable, "-X", "importtime", os.path.join(ROOT, "main.py")] + args
+    res = subprocess.run(cmd, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    times = {}
+    for line in res.stderr.decode().splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line[len("import time:"):].split("|")
+        times[module.strip()] = int(cumulative)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--budget", type=float, default=DEFAULT_BUDGET,
+                        help="Milliseconds (default: {})".format(DEFAULT_BUDGET))
+    parser.add_argument("--runs", type=int, default=5,
+                        help="Keep the fastest of this many runs (default: 5)")
+    args = parser.parse_args()
+
+    runs = [import_times(["--help"]) for _ in range(args.runs)]
+    best = min(runs, key=lambda times: times.get("lib.cli.app", 0))
+    failed = False
+
+    loaded = [module for module in FORBIDDEN if module in best]
+    if loaded:
+        print("FAIL --help imports {}".format(", ".join(loaded)))
+        failed = True
+
+    elapsed = best.get("lib.cli.app", 0) / 1000
+    print("lib.cli.app imports in {:.1f}ms (budget {:.0f}ms)".format(elapsed, args.budget))
+    if elapsed > args.budget:
+        failed = True
+        top = sorted(best.items(), key=lambda item: -item[1])[:10]
+        for module, micros in top:
+            print("  {:>8.1f}ms  {}".format(micros / 1000, module))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+"""Run esctl commands against the local stand-in and report wall time, request count and peak
+memory per command. Results are compared against, and with --save written to, a tracked results
+file so regressions show up in review.
+
+Usage: python3 -m bench.suite [--indices N] [--snapshots N] [--latency S] [--save]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+from bench.fake_es import FakeES
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_FILE = os.path.join(ROOT, "bench", "results.json")
+REPO = "bench"
+# Relative increase of wall time or peak memory that counts as a regression
+DEFAULT_TOLERANCE = 0.25
+# Wall time differences below this many seconds are noise, mostly interpreter startup
+MIN_WALL_TIME_DELTA = 0.1
+
+SCENARIOS = [
+    ("snapshot ls", ["snapshot", "ls", "--repo", REPO]),
+    ("snapshot create", ["snapshot", "create", "--repo", REPO]),
+    ("snapshot restore", ["snapshot", "restore", "--repo", REPO, "--wait-for", "green"]),
+    ("snapshot restore --fast", ["snapshot", "restore", "--repo", REPO, "--wait-for", "green",
+                                 "--fast"]),
+    ("snapshot create --partitions", ["snapshot", "create", "--repo", REPO, "--partitions", "4"]),
+    ("snapshot cleanup", ["snapshot", "cleanup", "--repo", REPO, "--keep", "5"]),
+    ("cluster status", ["cluster", "status"]),
+    ("cluster settings", ["cluster", "settings"]),
+    ("cluster set", ["cluster", "set", "--key", "cluster.routing.allocation.enable",
+                     "--value", "all"]),
+    ("cluster verify-repos", ["cluster", "verify-repos", "--repo", REPO]),
+]
+
+
+def run_scenario(args, config):
+    """Run one command against a fresh stand-in, returns its metrics"""
+    with FakeES(latency=config["latency"], indices=config["indices"],
+                snapshots=config["snapshots"], snapshot_duration=config["snapshot_duration"],
+                restore_duration=config["restore_duration"]) as fake, \
+            tempfile.TemporaryDirectory() as cache:
+        fake.repos[REPO] = {"type": "fs", "settings": {"location": "/tmp"}}
+        env = dict(os.environ, XDG_CACHE_HOME=cache)
+        cmd = [sys.executable, os.path.join(ROOT, "main.py")] + args + ["--url", fake.url]
+        # stderr goes to a file, a pipe could fill up while we are blocked in wait4
+        with tempfile.TemporaryFile() as stderr:
+            start = time.perf_counter()
+            proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL,
+                                    stderr=stderr)
+            # wait4 reports the peak memory of this child only, unlike RUSAGE_CHILDREN
+            _, status, usage = os.wait4(proc.pid, 0)
+            elapsed = time.perf_counter() - start
+            proc.returncode = os.waitstatus_to_exitcode(status) \
+                if hasattr(os, "waitstatus_to_exitcode") else status >> 8
+            stderr.seek(0)
+            errors = stderr.read().decode(errors="replace")
+        if proc.returncode != 0:
+            raise Exception("'{}' failed with exit code {}:\n{}".format(
+                " ".join(args), proc.returncode, errors))
+        return dict(wall_time=round(elapsed, 3), requests=fake.requests,
+                    peak_rss_kb=usage.ru_maxrss)
+
+
+def run_suite(config, only=None, repeat=1):
+    """Returns metrics per scenario, keeping the fastest of `repeat` runs"""
+    results = {}
+    for name, args in SCENARIOS:
+        if only and not any(pattern in name for pattern in only):
+            continue
+        runs = [run_scenario(args, config) for _ in range(repeat)]
+        results[name] = min(runs, key=lambda r: r["wall_time"])
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Returns a list of regressions compared to the baseline results"""
+    regressions = []
+    for name, metrics in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if metrics["requests"] > base["requests"]:
+            regressions.append("{}: requests {} -> {}".format(
+                name, base["requests"], metrics["requests"]))
+        if metrics["wall_time"] > max(base["wall_time"] * (1 + tolerance),
+                                      base["wall_time"] + MIN_WALL_TIME_DELTA):
+            regressions.append("{}: wall_time {} -> {}".format(
+                name, base["wall_time"], metrics["wall_time"]))
+        if metrics["peak_rss_kb"] > base["peak_rss_kb"] * (1 + tolerance):
+            regressions.append("{}: peak_rss_kb {} -> {}".format(
+                name, base["peak_rss_kb"], metrics["peak_rss_kb"]))
+    return regressions
+
+
+def print_results(results, baseline):
+    row = "{:<30} {:>10} {:>9} {:>12} {:>9} {:>9}"
+    print(row.format("command", "wall time", "requests", "peak rss", "Δ time", "Δ rss"))
+    for name, metrics in results.items():
+        base = baseline.get(name)
+        print(row.format(
+            name,
+            "{:.3f}s".format(metrics["wall_time"]),
+            metrics["requests"],
+            "{:.1f} MB".format(metrics["peak_rss_kb"] / 1024),
+            _delta(metrics["wall_time"], base["wall_time"]) if base else "-",
+            _delta(metrics["peak_rss_kb"], base["peak_rss_kb"]) if base else "-"))
+
+
+def _delta(value, base):
+    if not base:
+        return "-"
+    return "{:+.0%}".format(value / base - 1)
+
+
+def load_results(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--indices", type=int, default=50)
+    parser.add_argument("--snapshots", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.005,
+                        help="Seconds added to every response")
+    parser.add_argument("--snapshot-duration", type=float, default=1.0)
+    parser.add_argument("--restore-duration", type=float, default=1.0)
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="Run each command this many times and keep the fastest")
+    parser.add_argument("--only", nargs="+", help="Only run commands containing these words")
+    parser.add_argument("--results", default=RESULTS_FILE)
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--save", action="store_true",
+                        help="Write results to the results file")
+    args = parser.parse_args()
+
+    config = dict(indices=args.indices, snapshots=args.snapshots, latency=args.latency,
+                  snapshot_duration=args.snapshot_duration,
+                  restore_duration=args.restore_duration)
+    saved = load_results(args.results)
+    baseline = saved["results"] if saved and saved["config"] == config else {}
+    if saved and not baseline:
+        print("Not comparing, {} was recorded with {}".format(args.results, saved["config"]))
+
+    results = run_suite(config, args.only, args.repeat)
+    print_results(results, baseline)
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print("REGRESSION {}".format(regression))
+
+    if args.save:
+        if saved and saved["config"] == config:
+            results = dict(saved["results"], **results)
+        with open(args.results, "w") as f:
+            json.dump(dict(config=config, python=platform.python_version(), results=results),
+                      f, indent=2, sort_keys=True)
+            f.write("\n")
+    elif regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,7 @@
 """Commandline interface"""
 
+from importlib import import_module
 from lib.cli.arg_parser import arg_parser
-import json
 
 
 SENSITIVE = ["http_password"]
@@ -15,11 +15,39 @@ def run():
     if "func" not in args:
         parser.print_help()
     else:
+        # Commands are given as "module:function" and only imported once dispatched, so help
+        # and usage errors don't pay for loading the HTTP client
+        args.func = _load(args.func)
+        if args.profile or args.profile_json:
+            _profiled(args)
+        else:
+            args.func(**vars(args))
+
+
+def _load(target):
+    """Import the function named by a "module:function" string"""
+    module, func = target.split(":")
+    return getattr(import_module(module), func)
+
+
+def _profiled(args):
+    """Run the command, then report request timings"""
+    from lib.es.profile import Profiler
+    profiler = Profiler()
+    profiler.install()
+    try:
         args.func(**vars(args))
+    finally:
+        profiler.uninstall()
+        if args.profile:
+            profiler.print_summary()
+        if args.profile_json:
+            profiler.dump(args.profile_json)
 
 
 def print_args(args):
     """Print options for debugging"""
+    import json
     hsh = {}
     for key, value in vars(args).items():
         if value is None or key == "func":
@@ -1,11 +1,22 @@
 """Factory for command line argument parser"""
 
 import argparse
-import lib.cli.snapper as snapper
-import lib.cli.cluster as cluster
 from os import environ as env
+from lib.es.defaults import DEFAULT_POOL_SIZE, DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT, \
+    DEFAULT_CONCURRENCY, DEFAULT_CLUSTER_TIMEOUT, DEFAULT_RETRIES, DEFAULT_MAX_BACKOFF
+from lib.es.catalog import DEFAULT_TTL
+from lib.es.progress import DEFAULT_INTERVAL
+from lib.es.incremental import DEFAULT_FULL_EVERY
+from lib.es.nodestats import DEFAULT_INTERVAL as DEFAULT_TOP_INTERVAL
 
 DEFAULT_KEEP = "5"
+DEFAULT_LISTEN = "127.0.0.1:9180"
+
+
+def _csv(value):
+    """Parse comma separated list argument"""
+    return [item.strip() for item in value.split(",") if item.strip()]
+
 
 def arg_parser():
     """Set up command line args and returns the resulting ArgumentParser"""
@@ -34,6 +45,51 @@ def arg_parser():
                         required=False,
                         dest="password",
                         help="HTTP Basic password if server requires auth")
+    defaults.add_argument("--pool-size",
+                        default=DEFAULT_POOL_SIZE,
+                        required=False,
+                        type=int,
+                        help="Max. number of pooled keep-alive connections (default: {})".format(
+                            DEFAULT_POOL_SIZE))
+    defaults.add_argument("--connect-timeout",
+                        default=DEFAULT_CONNECT_TIMEOUT,
+                        required=False,
+                        type=float,
+                        help="Seconds to wait for a connection (default: {})".format(
+                            DEFAULT_CONNECT_TIMEOUT))
+    defaults.add_argument("--read-timeout",
+                        default=DEFAULT_READ_TIMEOUT,
+                        required=False,
+                        type=float,
+                        help="Seconds to wait for a response (default: {})".format(
+                            DEFAULT_READ_TIMEOUT))
+    defaults.add_argument("--retries",
+                        default=DEFAULT_RETRIES,
+                        required=False,
+                        type=int,
+                        help="Times to retry idempotent requests rejected by a busy cluster, "
+                             "0 disables (default: {})".format(DEFAULT_RETRIES))
+    defaults.add_argument("--max-backoff",
+                        default=DEFAULT_MAX_BACKOFF,
+                        required=False,
+                        type=float,
+                        help="Max. seconds to wait before a retry (default: {})".format(
+                            DEFAULT_MAX_BACKOFF))
+    defaults.add_argument("--concurrency",
+                        default=DEFAULT_CONCURRENCY,
+                        required=False,
+                        type=int,
+                        help="Max. number of requests in flight for fan-out work, 1 runs "
+                             "sequentially (default: {})".format(DEFAULT_CONCURRENCY))
+    defaults.add_argument("--profile",
+                        action="store_true",
+                        default=False,
+                        required=False,
+                        help="Print per endpoint request timings to stderr at exit")
+    defaults.add_argument("--profile-json",
+                        required=False,
+                        metavar="FILE",
+                        help="Write per endpoint request timings as JSON to FILE, - for stdout")
 
     # Default args for snapshots
     snapshot_defaults = argparse.ArgumentParser(add_help=False, parents=[defaults])
@@ -47,6 +103,59 @@ def arg_parser():
                                     default="snapper-snapshots",
                                     required=False,
                                     help="Name of the repo to use (default: snapper-snapshots)")
+    snapshot_defaults.add_argument("--no-cache",
+                                    required=False,
+                                    dest="no_cache",
+                                    action="store_true",
+                                    help="Always fetch the snapshot catalog from the cluster")
+    snapshot_defaults.add_argument("--cache-ttl",
+                                    default=DEFAULT_TTL,
+                                    required=False,
+                                    type=float,
+                                    help="Seconds the cached snapshot catalog is used without "
+                                         "refreshing (default: {})".format(DEFAULT_TTL))
+    snapshot_defaults.add_argument("--skip-repo-check",
+                                    required=False,
+                                    dest="skip_repo_check",
+                                    action="store_true",
+                                    help="Assume the repo exists, don't check or create it")
+    snapshot_defaults.add_argument("--progress-interval",
+                                    default=DEFAULT_INTERVAL,
+                                    required=False,
+                                    type=float,
+                                    help="Seconds between progress reports while waiting, 0 "
+                                         "disables them (default: {})".format(DEFAULT_INTERVAL))
+    snapshot_defaults.add_argument("--state-file",
+                                    default=None,
+                                    required=False,
+                                    dest="state_file",
+                                    help="File recording which snapshot holds the latest copy of "
+                                         "each index, written by --changed-only. Restoring "
+                                         "'latest' restores from all of these snapshots, cleanup "
+                                         "keeps them")
+
+    # Options for taking snapshots
+    create_options = argparse.ArgumentParser(add_help=False)
+    create_options.add_argument("--changed-only",
+                                      required=False,
+                                      dest="changed_only",
+                                      action="store_true",
+                                      help="Only snapshot indices changed since they were last "
+                                           "snapshotted, requires --state-file")
+    create_options.add_argument("--full-every",
+                                      default=DEFAULT_FULL_EVERY,
+                                      required=False,
+                                      dest="full_every",
+                                      type=int,
+                                      help="With --changed-only, snapshot all indices every n-th "
+                                           "time (default: {})".format(DEFAULT_FULL_EVERY))
+    create_options.add_argument("--partitions",
+                                      default=1,
+                                      required=False,
+                                      dest="partitions",
+                                      type=int,
+                                      help="Split indices into this many snapshots of about equal "
+                                           "size taken concurrently, on ES 7.9+ (default: 1)")
 
     # Snapshot sub-commands
     snapshot_parser = main_sp.add_parser("snapshot", help="Snapshot sub-commands")
@@ -56,7 +165,7 @@ def arg_parser():
     snapshot_create = snapshot_sp.add_parser(
                             "create", 
                             help="create snapshot",
-                            parents=[snapshot_defaults])
+                            parents=[snapshot_defaults, create_options])
     snapshot_create.add_argument("--cleanup",
                             required=False,
                             dest="cleanup",
@@ -65,7 +174,23 @@ def arg_parser():
                             default=DEFAULT_KEEP,
                             required=False,
                             type=int)
-    snapshot_create.set_defaults(func=snapper.create)
+    snapshot_create.add_argument("--timeout",
+                            default=None,
+                            required=False,
+                            type=float,
+                            help="Give up waiting for the snapshot after this many seconds "
+                                 "(default: wait until done)")
+    snapshot_create.add_argument("--events",
+                            default=None,
+                            required=False,
+                            help="Append snapshot progress as JSON lines to this file, '-' for "
+                                 "stdout (other output then goes to stderr)")
+    snapshot_create.add_argument("--prom-file",
+                            default=None,
+                            required=False,
+                            dest="prom_file",
+                            help="Write stats of the snapshot to this Prometheus textfile")
+    snapshot_create.set_defaults(func="lib.cli.snapper:create")
 
     # Snapshot - Restore
     snapshot_restore = snapshot_sp.add_parser(
@@ -81,14 +206,46 @@ def arg_parser():
                             required=False,
                             dest='ignore_missing',
                             action='store_true')
-    snapshot_restore.set_defaults(func=snapper.restore)
+    snapshot_restore.add_argument("--timeout",
+                            default=None,
+                            required=False,
+                            type=float,
+                            help="Give up waiting for the cluster status after this many seconds "
+                                 "(default: wait until reached)")
+    snapshot_restore.add_argument("--fast",
+                            required=False,
+                            action="store_true",
+                            help="Restore without replicas and refreshes and with raised "
+                                 "recovery limits until primaries are active")
+    snapshot_restore.add_argument("--indices",
+                            default=None,
+                            required=False,
+                            type=_csv,
+                            help="Comma separated index patterns to restore, a leading '-' "
+                                 "excludes matches (default: all indices in the snapshot)")
+    snapshot_restore.add_argument("--rename-pattern",
+                            default=None,
+                            required=False,
+                            dest="rename_pattern",
+                            help="Regular expression applied to names of restored indices")
+    snapshot_restore.add_argument("--rename-replacement",
+                            default=None,
+                            required=False,
+                            dest="rename_replacement",
+                            help="Replacement for --rename-pattern, groups are referred to as $1")
+    snapshot_restore.add_argument("--include-global-state",
+                            required=False,
+                            dest="include_global_state",
+                            action="store_true",
+                            help="Also restore templates and persistent cluster settings")
+    snapshot_restore.set_defaults(func="lib.cli.snapper:restore")
 
     # Snapshot - List
     snapshot_ls = snapshot_sp.add_parser(
                             "ls", 
                             help="list snapshots",
                             parents=[snapshot_defaults])
-    snapshot_ls.set_defaults(func=snapper.ls)
+    snapshot_ls.set_defaults(func="lib.cli.snapper:ls")
 
     # Snapshot - Cleanup
     snapshot_cleanup = snapshot_sp.add_parser(
@@ -99,7 +256,36 @@ def arg_parser():
                             default=DEFAULT_KEEP,
                             required=False,
                             type=int)
-    snapshot_cleanup.set_defaults(func=snapper.cleanup)
+    snapshot_cleanup.add_argument("--dry-run",
+                            required=False,
+                            dest="dry_run",
+                            action="store_true",
+                            help="Only print which snapshots would be deleted")
+    snapshot_cleanup.set_defaults(func="lib.cli.snapper:cleanup")
+
+    # Options for cluster commands which can run against many clusters at once
+    fleet_defaults = argparse.ArgumentParser(add_help=False, parents=[defaults])
+    fleet_defaults.add_argument("--urls",
+                        nargs="+",
+                        required=False,
+                        metavar="URL",
+                        help="Query these clusters concurrently instead of --url")
+    fleet_defaults.add_argument("--inventory",
+                        required=False,
+                        metavar="FILE",
+                        help="Query the clusters listed in FILE concurrently, one 'url' or "
+                             "'name url' per line")
+    fleet_defaults.add_argument("--cluster-timeout",
+                        default=DEFAULT_CLUSTER_TIMEOUT,
+                        required=False,
+                        type=float,
+                        dest="cluster_timeout",
+                        help="Seconds to wait for each cluster to connect and respond "
+                             "(default: {})".format(DEFAULT_CLUSTER_TIMEOUT))
+    fleet_defaults.add_argument("--output", "-o",
+                        default="table",
+                        choices=("table", "json"),
+                        help="Print a table or JSON lines for many clusters (default: table)")
 
     # Cluster commands
     cluster_parser = main_sp.add_parser("cluster", help="Cluster sub-commands")
@@ -119,21 +305,91 @@ def arg_parser():
     cluster_set.add_argument("--transient",
                             required=False,
                             action="store_true")
-    cluster_set.set_defaults(func=cluster.settings_set)
+    cluster_set.set_defaults(func="lib.cli.cluster:settings_set")
+
+    # Cluster apply settings from a file
+    cluster_apply = cluster_sp.add_parser(
+                            "apply",
+                            help="Apply cluster settings from a file with a single update",
+                            parents=[defaults])
+    cluster_apply.add_argument("--file", "-f",
+                            required=True,
+                            dest="path",
+                            help="JSON or YAML file mapping 'persistent' and/or 'transient' to "
+                                 "settings, null resets a setting")
+    cluster_apply.add_argument("--dry-run",
+                            required=False,
+                            action="store_true",
+                            help="Only print the changes")
+    cluster_apply.add_argument("--backup",
+                            required=False,
+                            help="Write the previous values of changed settings to this file, "
+                                 "apply it to roll back")
+    cluster_apply.set_defaults(func="lib.cli.cluster:settings_apply")
 
     # Cluster get settings
     cluster_settings = cluster_sp.add_parser(
                             "settings", 
                             help="Get cluster wide settings",
-                            parents=[defaults])
-    cluster_settings.set_defaults(func=cluster.settings)
+                            parents=[fleet_defaults])
+    cluster_settings.set_defaults(func="lib.cli.cluster:settings")
     
     # Cluster status
     cluster_status = cluster_sp.add_parser(
                             "status", 
                             help="Get cluster status",
+                            parents=[fleet_defaults])
+    cluster_status.set_defaults(func="lib.cli.cluster:status")
+
+    # Cluster shard balance
+    cluster_shards = cluster_sp.add_parser(
+                            "shards",
+                            help="Show how shards and load are spread across nodes",
                             parents=[defaults])
-    cluster_status.set_defaults(func=cluster.status)
+    cluster_shards.add_argument("--top",
+                            default=10,
+                            required=False,
+                            type=int,
+                            help="Number of indices most concentrated on one node to list "
+                                 "(default: 10)")
+    cluster_shards.add_argument("--output", "-o",
+                            choices=["table", "json"],
+                            default="table",
+                            required=False,
+                            help="Print tables or the report as JSON (default: table)")
+    cluster_shards.set_defaults(func="lib.cli.cluster:shards")
+
+    # Cluster node load
+    cluster_top = cluster_sp.add_parser(
+                            "top",
+                            help="Show indexing, search, GC, rejection, merge and disk I/O rates "
+                                 "per node",
+                            parents=[defaults])
+    cluster_top.add_argument("--interval",
+                            default=DEFAULT_TOP_INTERVAL,
+                            required=False,
+                            type=float,
+                            help="Seconds between samples (default: {})".format(
+                                DEFAULT_TOP_INTERVAL))
+    cluster_top.add_argument("--count",
+                            default=0,
+                            required=False,
+                            type=int,
+                            help="Stop after this many samples, 0 runs until interrupted "
+                                 "(default: 0)")
+    cluster_top.add_argument("--sort",
+                            choices=["node", "index", "search", "gc_ms", "rejected", "merges",
+                                     "read_kb", "write_kb"],
+                            default="index",
+                            required=False,
+                            help="Column to sort nodes by, highest rate first (default: index)")
+    cluster_top.add_argument("--output", "-o",
+                            choices=["table", "json"],
+                            default="table",
+                            required=False,
+                            help="Refresh a table, or print a JSON line per sample "
+                                 "(default: table)")
+    cluster_top.set_defaults(func="lib.cli.cluster:top")
 
     # Cluster rebalance settings
     cluster_rebalance = cluster_sp.add_parser(
@@ -144,6 +400,61 @@ def arg_parser():
                             choices=["all", "primaries", "new_primaries", "none"],
                             required=True,
                             type=str)
-    cluster_rebalance.set_defaults(func=cluster.set_rebalancing)
+    cluster_rebalance.set_defaults(func="lib.cli.cluster:set_rebalancing")
+
+    # Cluster verify snapshot repos
+    cluster_verify = cluster_sp.add_parser(
+                            "verify-repos",
+                            help="Verify snapshot repositories concurrently",
+                            parents=[defaults])
+    cluster_verify.add_argument("--repo",
+                            required=True,
+                            dest="repos",
+                            nargs="+",
+                            help="Names of the repos to verify")
+    cluster_verify.set_defaults(func="lib.cli.cluster:verify_repos")
+
+    # Daemon
+    daemon = main_sp.add_parser(
+                            "daemon",
+                            help="Run snapshot, cleanup and health check jobs on a schedule",
+                            parents=[snapshot_defaults, create_options])
+    daemon.add_argument("--snapshot-schedule",
+                            default="@hourly",
+                            dest="snapshot_schedule",
+                            help="Cron expression (UTC) for snapshots, 'off' disables them "
+                                 "(default: @hourly)")
+    daemon.add_argument("--cleanup-schedule",
+                            default="30 * * * *",
+                            dest="cleanup_schedule",
+                            help="Cron expression (UTC) for cleanups, 'off' disables them "
+                                 "(default: '30 * * * *')")
+    daemon.add_argument("--health-schedule",
+                            default="* * * * *",
+                            dest="health_schedule",
+                            help="Cron expression (UTC) for cluster health checks, 'off' "
+                                 "disables them (default: every minute)")
+    daemon.add_argument("--jitter",
+                            default=30,
+                            type=float,
+                            help="Delay each run by a random number of seconds up to this "
+                                 "(default: 30)")
+    daemon.add_argument("--keep",
+                            default=DEFAULT_KEEP,
+                            type=int)
+    daemon.add_argument("--timeout",
+                            default=None,
+                            type=float,
+                            help="Give up waiting for a snapshot after this many seconds "
+                                 "(default: wait until done)")
+    daemon.add_argument("--prom-file",
+                            default=None,
+                            dest="prom_file",
+                            help="Write stats of each snapshot to this Prometheus textfile")
+    daemon.add_argument("--listen",
+                            default=DEFAULT_LISTEN,
+                            help="host:port for the status endpoint, 'off' disables it "
+                                 "(default: {})".format(DEFAULT_LISTEN))
+    daemon.set_defaults(func="lib.cli.daemon:daemon")
 
     return main_parser
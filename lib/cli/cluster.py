@@ -1,10 +1,34 @@
 """Bridge between CLI and cluster level actions"""
 
 from lib.es.cluster import new_cluster
+from lib.es.async_client import run
+from lib.es.fleet import Target, fan_out, load_inventory
+from lib.es.settings import load_settings, rollback
+from lib.es.units import format_bytes
+from lib.es.nodestats import RATES
+from lib.es.poll import sleep
+import sys
 import json
+import time
 
+STATUS_ROW = "{:<24} {:<7} {:>5} {:>5} {:>10} {:>7} {:>7}  {}"
+SETTINGS_ROW = "{:<24} {:<10} {:<50} {}"
+APPLY_ROW = "{:<10} {:<50} {} -> {}"
+NODE_ROW = "{:<24} {:>7} {:>9} {:>10} {:>5} {:>5}  {}"
+OFFENDER_ROW = "{:<40} {:<24} {:>7} {:>7} {:>10}"
+TOP_ROW = "{:<24} {:>9} {:>9} {:>8} {:>9} {:>8} {:>10} {:>10}"
+TOP_HEADER = TOP_ROW.format("NODE", "INDEX/s", "SEARCH/s", "GC ms/s", "REJECTS/s", "MERGES/s",
+                            "READ KB/s", "WRITE KB/s")
+# Move the cursor home and clear the screen
+CLEAR = "\033[H\033[2J"
 
-def status(**args):
+
+def status(urls=None, inventory=None, **args):
+    if urls or inventory:
+        _fleet(urls, inventory, lambda cluster: cluster.status(), _status_rows,
+               STATUS_ROW.format("CLUSTER", "STATUS", "NODES", "DATA", "UNASSIGNED", "PENDING",
+                                 "TIME", "ERROR"), **args)
+        return
     cluster = _from_args(**args)
     status = cluster.status()
     print("Cluster name:       {}".format(status["cluster_name"]))
@@ -28,17 +52,206 @@ def settings_set(key, value, transient, **args):
     _print_response(data)
 
 
-def settings(**args):
+def settings_apply(path, dry_run=False, backup=None, **args):
+    """Apply settings from a file, printing the changes first"""
+    desired = load_settings(path)
+    cluster = _from_args(**args)
+    changes = cluster.settings_plan(desired)
+    for change in changes:
+        print(APPLY_ROW.format(change.scope, change.key, _setting_value(change.old),
+                               _setting_value(change.new)))
+    unchanged = sum(len(values) for values in desired.values()) - len(changes)
+    print("{} change(s), {} setting(s) already up to date".format(len(changes), unchanged))
+    if dry_run or not changes:
+        return
+
+    if backup:
+        with open(backup, "w") as f:
+            json.dump(rollback(changes), f, sort_keys=True, indent=2)
+        print("Previous values written to {}".format(backup))
+    data = cluster.settings_apply(changes)
+    _print_response(data)
+
+
+def shards(top=10, output="table", **args):
+    """Print shard balance across nodes and suggested actions"""
+    cluster = _from_args(**args)
+    report = cluster.shard_report(top)
+    if output == "json":
+        _print_response(report)
+        return
+
+    print(NODE_ROW.format("NODE", "SHARDS", "PRIMARIES", "SIZE", "DISK", "HEAP", "HOT"))
+    for node in report["nodes"]:
+        print(NODE_ROW.format(node["node"], node["shards"], node["primaries"],
+                              format_bytes(node["bytes"]), _percent(node["disk_percent"]),
+                              _percent(node["heap_percent"]), ",".join(node["hot"])))
+    for name, skew in sorted(report["skew"].items()):
+        print("{} skew: max {}, mean {}, max/mean {}, cv {}".format(
+            name, format_bytes(skew["max"]) if name == "bytes" else skew["max"],
+            format_bytes(skew["mean"]) if name == "bytes" else skew["mean"],
+            skew["ratio"], skew["cv"]))
+    print("{} shard copies, {} unassigned".format(report["shards"], report["unassigned"]))
+
+    if report["offenders"]:
+        print()
+        print(OFFENDER_ROW.format("INDEX", "NODE", "SHARDS", "EVEN", "SIZE"))
+        for offender in report["offenders"]:
+            print(OFFENDER_ROW.format(offender["index"], offender["node"], offender["shards"],
+                                      offender["even"], format_bytes(offender["bytes"])))
+    if report["suggestions"]:
+        print()
+        for suggestion in report["suggestions"]:
+            print("# " + suggestion["reason"])
+            print(suggestion["action"])
+
+
+def top(interval=5, count=0, sort="index", output="table", **args):
+    """Sample node stats every `interval` seconds and print rates per node"""
+    cluster = _from_args(**args)
+    sampler = cluster.node_sampler()
+    refresh = output == "table" and sys.stdout.isatty()
+    _sample(sampler)
+    samples = 0
+    try:
+        while not count or samples < count:
+            sleep(interval)
+            rates = _sample(sampler)
+            samples += 1
+            if rates is None:
+                continue
+            if output == "json":
+                print(json.dumps(dict(
+                    time=round(time.time(), 3),
+                    nodes=dict((name, dict(zip(RATES, (round(rate, 2) for rate in node_rates))))
+                               for name, node_rates in rates.items())), sort_keys=True))
+            else:
+                _print_top(rates, sampler.averages(), len(sampler.history), sort, refresh)
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+
+
+def _sample(sampler):
+    """Returns the rates of a new sample, or None if sampling failed. A failed sample is reported
+    and skipped, the next one covers its interval"""
+    try:
+        return sampler.sample()
+    except Exception as err:
+        print("Failed to sample node stats: {}".format(err), file=sys.stderr)
+        return None
+
+
+def _print_top(rates, averages, samples, sort, refresh):
+    if refresh:
+        print(CLEAR, end="")
+    print(time.strftime("%H:%M:%S"), "{} node(s)".format(len(rates)))
+    print(TOP_HEADER)
+    if sort == "node":
+        rows = sorted(rates.items())
+    else:
+        column = RATES.index(sort)
+        rows = sorted(rates.items(), key=lambda item: -item[1][column])
+    for name, node_rates in rows:
+        print(TOP_ROW.format(name, *("{:.1f}".format(rate) for rate in node_rates)))
+    print(TOP_ROW.format("cluster avg ({} samples)".format(samples),
+                         *("{:.1f}".format(rate) for rate in averages)))
+    if not refresh:
+        print()
+
+
+def settings(urls=None, inventory=None, **args):
+    if urls or inventory:
+        _fleet(urls, inventory, lambda cluster: cluster.settings_get(flat=True), _settings_rows,
+               SETTINGS_ROW.format("CLUSTER", "SCOPE", "KEY", "VALUE"), **args)
+        return
     cluster = _from_args(**args)
     data = cluster.settings_get()
     _print_response(data)
 
 
+def verify_repos(repos, **args):
+    cluster = _from_args(**args)
+    try:
+        data = run(cluster.verify_repos_async(repos))
+    finally:
+        cluster.close()
+    _print_response(data)
+
+
 def _from_args(**args):
     return new_cluster(
         args["url"], 
         args["user"], 
-        args["password"])
+        args["password"],
+        concurrency=args["concurrency"],
+        pool_size=args["pool_size"],
+        connect_timeout=args["connect_timeout"],
+        read_timeout=args["read_timeout"],
+        retries=args["retries"],
+        max_backoff=args["max_backoff"])
+
+
+def _fleet(urls, inventory, action, rows, header, output="table", cluster_timeout=None,
+           **args):
+    """Run action against all clusters given, printing results as they arrive. Exits non-zero
+    if any cluster failed"""
+    targets = [Target(url) for url in urls or []]
+    if inventory:
+        targets += load_inventory(inventory)
+    started = time.monotonic()
+    if output == "table":
+        print(header)
+    failed = 0
+    for result in fan_out(targets, action, args["concurrency"], cluster_timeout,
+                          args["user"], args["password"], pool_size=args["pool_size"]):
+        failed += result.error is not None
+        if output == "json":
+            print(json.dumps(dict(cluster=result.target.name, url=result.target.url,
+                                  elapsed=round(result.elapsed, 3), result=result.value,
+                                  error=result.error), sort_keys=True))
+        else:
+            for row in rows(result):
+                print(row)
+        sys.stdout.flush()
+    print("{} cluster(s), {} failed, took {:.1f}s".format(
+        len(targets), failed, time.monotonic() - started), file=sys.stderr)
+    if failed:
+        sys.exit(1)
+
+
+def _status_rows(result):
+    name = result.target.name
+    elapsed = "{:.2f}s".format(result.elapsed)
+    if result.error:
+        yield STATUS_ROW.format(name, "-", "-", "-", "-", "-", elapsed, result.error)
+        return
+    data = result.value
+    yield STATUS_ROW.format(name, data["status"], data["number_of_nodes"],
+                            data["number_of_data_nodes"], data["unassigned_shards"],
+                            data["number_of_pending_tasks"], elapsed, "")
+
+
+def _settings_rows(result):
+    name = result.target.name
+    if result.error:
+        yield SETTINGS_ROW.format(name, "-", "-", "error: " + result.error)
+        return
+    empty = True
+    for scope in ("persistent", "transient"):
+        for key, value in sorted(result.value.get(scope, {}).items()):
+            empty = False
+            yield SETTINGS_ROW.format(name, scope, key, json.dumps(value))
+    if empty:
+        yield SETTINGS_ROW.format(name, "-", "-", "")
+
+
+def _percent(value):
+    return "-" if value is None else "{}%".format(value)
+
+
+def _setting_value(value):
+    return "(default)" if value is None else json.dumps(value)
 
 
 def _print_response(data):
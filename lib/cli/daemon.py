@@ -0,0 +1,71 @@
+"""Bridge between CLI and the job scheduler"""
+
+import signal
+import threading
+from lib.es.client import Client
+from lib.es.catalog import CatalogCache
+from lib.es.cluster import Cluster
+from lib.es.snapper import Snapper
+from lib.es.incremental import SnapshotState
+from lib.es.schedule import Cron
+from lib.es.daemon import Job, Scheduler, StatusServer
+
+
+def daemon(snapshot_schedule, cleanup_schedule, health_schedule, jitter, keep, timeout=None,
+           prom_file=None, listen=None, changed_only=False, full_every=None, partitions=1,
+           **args):
+    """Run scheduled jobs until terminated. All jobs share one client and connection pool"""
+    client = Client(args["url"], args["user"], args["password"],
+                    pool_size=args["pool_size"],
+                    connect_timeout=args["connect_timeout"],
+                    read_timeout=args["read_timeout"],
+                    retries=args["retries"],
+                    max_backoff=args["max_backoff"])
+    cache = None if args["no_cache"] else CatalogCache(args["url"], args["repo"], args["cache_ttl"])
+    state = SnapshotState(args["state_file"]) if args["state_file"] else None
+    snapper = Snapper(client, args["repo"], args["bucket"], args["region"], args["concurrency"],
+                      cache, args["skip_repo_check"], args["progress_interval"], state)
+    cluster = Cluster(client, args["concurrency"])
+
+    def health():
+        status = cluster.status()
+        print("Cluster {} is {}, {} node(s), {} unassigned shard(s)".format(
+            status["cluster_name"], status["status"], status["number_of_nodes"],
+            status["unassigned_shards"]))
+        if status["status"] == "red":
+            raise Exception("Cluster {} is red".format(status["cluster_name"]))
+
+    # A cleanup waits for a running snapshot, ES refuses to delete snapshots during one
+    snapshot_lock = threading.Lock()
+    jobs = []
+    for name, schedule, func, exclusive in (
+            ("snapshot", snapshot_schedule,
+             lambda: snapper.snapshot(timeout, None, prom_file, changed_only, full_every,
+                                      partitions),
+             snapshot_lock),
+            ("cleanup", cleanup_schedule, lambda: snapper.cleanup(keep), snapshot_lock),
+            ("health", health_schedule, health, None)):
+        if schedule != "off":
+            jobs.append(Job(name, Cron(schedule), func, jitter, exclusive))
+    if not jobs:
+        raise Exception("All jobs are turned off")
+
+    scheduler = Scheduler(jobs)
+    server = None
+    if listen and listen != "off":
+        host, port = listen.rsplit(":", 1)
+        server = StatusServer(scheduler, host, int(port)).start()
+        print("Serving status on http://{}/status".format(server.address))
+
+    signal.signal(signal.SIGTERM, lambda *_: scheduler.stop())
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("Stopping")
+        if server:
+            server.stop()
+        snapper.close()
+        cluster.close()
+        client.close()
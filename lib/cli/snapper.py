@@ -1,38 +1,66 @@
 """Bridge between CLI and snapshot level actions"""
 
+import sys
+from contextlib import redirect_stdout
 from lib.es.snapper import new_snapper
+from lib.es.async_client import run
+from lib.es.events import EventLog
 
-def create(keep, cleanup, **args):
-    """Do snapshot"""
+def create(keep, cleanup, timeout=None, events=None, prom_file=None, changed_only=False,
+           full_every=None, partitions=1, **args):
+    """Do snapshot. With events written to stdout, other output goes to stderr so the events
+    can be parsed"""
     snapper = _from_args(**args)
-    snapper.snapshot()
-    if cleanup: 
-        snapper.cleanup(keep)
+    event_log = EventLog(events) if events else None
+    with redirect_stdout(sys.stderr if events == "-" else sys.stdout):
+        try:
+            snapper.snapshot(timeout, event_log, prom_file, changed_only, full_every, partitions)
+        finally:
+            if event_log:
+                event_log.close()
+        if cleanup:
+            snapper.cleanup(keep)
 
 
 def ls(**args):
     """Do list"""
     snapper = _from_args(**args)
-    snapshots = snapper.list_snapshots()
+    snapshots = snapper.iter_snapshot_groups(newest_first=False, with_indices=True)
     for snap in snapshots:
-        print("- snapshot: {}".format(snap["snapshot"]))
-        print("  start_time: {}".format(snap["start_time"]))
-        print("  end_time: {}".format(snap["end_time"]))
-        print("  version: {}".format(snap["version"]))
-        print("  indices: {}".format(len(snap["indices"])))
-        print("  state: {}".format(snap["state"]))
+        print("- snapshot: {}".format(snap.name))
+        print("  start_time: {}".format(snap.start_time))
+        print("  end_time: {}".format(snap.end_time))
+        print("  version: {}".format(snap.version))
+        print("  indices: {}".format(snap.index_count))
+        print("  state: {}".format(snap.state))
+        if snap.partitions:
+            print("  partitions: {}".format(", ".join(snap.partitions)))
 
 
-def restore(snapshot="latest", ignore_missing=True, wait_for="green", **args):
+def restore(snapshot="latest", ignore_missing=True, wait_for="green", timeout=None, fast=False,
+            indices=None, rename_pattern=None, rename_replacement=None,
+            include_global_state=False, **args):
     """Do restore"""
     snapper = _from_args(**args)
-    snapper.restore(snapshot, ignore_missing, wait_for)
+    selection = dict(
+        indices=indices,
+        rename_pattern=rename_pattern,
+        rename_replacement=rename_replacement,
+        include_global_state=include_global_state)
+    try:
+        if args["concurrency"] > 1:
+            run(snapper.restore_async(snapshot, ignore_missing, wait_for, timeout, fast,
+                                      **selection))
+        else:
+            snapper.restore(snapshot, ignore_missing, wait_for, timeout, fast, **selection)
+    finally:
+        snapper.close()
 
 
-def cleanup(keep, **args):
+def cleanup(keep, dry_run=False, **args):
     """Cleanup old snapshots"""
     snapper = _from_args(**args)
-    snapper.cleanup(keep)
+    snapper.cleanup(keep, dry_run)
 
 
 def _from_args(**args):
@@ -42,4 +70,15 @@ def _from_args(**args):
         repo=args["repo"],
         bucket=args["bucket"],
         region=args["region"],
-        password=args["password"])
+        password=args["password"],
+        concurrency=args["concurrency"],
+        use_cache=not args["no_cache"],
+        cache_ttl=args["cache_ttl"],
+        skip_repo_check=args["skip_repo_check"],
+        progress_interval=args["progress_interval"],
+        state_file=args["state_file"],
+        pool_size=args["pool_size"],
+        connect_timeout=args["connect_timeout"],
+        read_timeout=args["read_timeout"],
+        retries=args["retries"],
+        max_backoff=args["max_backoff"])
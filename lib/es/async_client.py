@@ -0,0 +1,59 @@
+"""Asyncio front-end for the blocking ES client"""
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from lib.es.defaults import DEFAULT_CONCURRENCY
+
+
+class AsyncClient:
+    """Awaitable variant of `lib.es.client.Client`. Requests are run on a bounded thread pool on
+    top of the wrapped client, so they share its pooled connections and at most `concurrency`
+    requests are in flight at any time"""
+
+    def __init__(self, es_client, concurrency=DEFAULT_CONCURRENCY):
+        if concurrency < 1:
+            raise Exception("Concurrency must be at least 1")
+        self._client = es_client
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+
+
+    def close(self):
+        """Shut down the worker threads, the wrapped client is left open"""
+        self._executor.shutdown(wait=True)
+
+
+    async def do_request(self, method, path, **kwargs):
+        """Make a generic request"""
+        loop = asyncio.get_event_loop()
+        call = functools.partial(self._client.do_request, method, path, **kwargs)
+        return await loop.run_in_executor(self._executor, call)
+
+
+    async def do_get(self, url, expected=200, **kwargs):
+        """Make a GET request"""
+        return await self.do_request("get", url, expected=expected, **kwargs)
+
+
+    async def do_put(self, url, payload=None, expected=200, **kwargs):
+        """Make a PUT request"""
+        return await self.do_request("put", url, payload=payload, expected=expected, **kwargs)
+
+
+    async def do_post(self, url, payload=None, expected=(200, 201), **kwargs):
+        """Make a POST request"""
+        return await self.do_request("post", url, payload=payload, expected=expected, **kwargs)
+
+
+    async def do_delete(self, url, expected=200, **kwargs):
+        """Make a DELETE request"""
+        return await self.do_request("delete", url, expected=expected, **kwargs)
+
+
+def run(coro):
+    """Run coroutine to completion on a fresh event loop and return its result"""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
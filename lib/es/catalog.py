@@ -0,0 +1,126 @@
+"""On-disk cache of the snapshot catalog of a repository"""
+
+import hashlib
+import json
+import os
+import sys
+import time
+from lib.es.records import SnapshotRecord
+
+
+DEFAULT_TTL = 300
+
+# Catalogs older than this are fetched completely again, dropping snapshots deleted elsewhere
+FULL_REFRESH_AGE = 24 * 3600
+
+# Seconds a repo seen by a previous run is trusted to exist without checking again
+REPO_CHECK_TTL = 60
+
+
+def cache_dir():
+    """Returns the directory esctl keeps its caches in"""
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "esctl")
+
+
+class CatalogCache:
+    """Snapshot records of one repo on one cluster, kept in a JSON file ordered oldest first.
+    Failing to read or write the file is never fatal, the cache then behaves as empty"""
+
+    def __init__(self, url, repo, ttl=DEFAULT_TTL, directory=None):
+        key = hashlib.sha1("{}|{}".format(url.rstrip("/"), repo).encode()).hexdigest()
+        self._path = os.path.join(directory or cache_dir(), "catalog-{}.json".format(key))
+        self._ttl = ttl
+        self._data = None
+
+
+    def records(self):
+        """Returns cached snapshot records, oldest first, or None if nothing is cached"""
+        data = self._load()
+        if data.get("snapshots") is None:
+            return None
+        return [SnapshotRecord(*fields) for fields in data["snapshots"]]
+
+
+    def is_fresh(self):
+        """True if the catalog was fetched less than `ttl` seconds ago"""
+        return time.time() - self._load().get("fetched_at", 0) < self._ttl
+
+
+    def needs_full_refresh(self):
+        """True if nothing is cached or the last complete fetch is too old"""
+        data = self._load()
+        return data.get("snapshots") is None or \
+            time.time() - data.get("full_at", 0) >= FULL_REFRESH_AGE
+
+
+    def store(self, records, full=False):
+        """Replace cached records, `full` marks them as the complete catalog"""
+        data = self._load()
+        now = time.time()
+        data["snapshots"] = [_fields(rec) for rec in sorted(records, key=lambda r: r.start_time)]
+        data["fetched_at"] = now
+        if full:
+            data["full_at"] = now
+        self._save()
+
+
+    def merge(self, records):
+        """Add or update the given records, keeping the rest of the catalog"""
+        names = set(rec.name for rec in records)
+        kept = [rec for rec in (self.records() or []) if rec.name not in names]
+        self.store(kept + list(records))
+
+
+    def remove(self, names):
+        """Drop the snapshots with the given names"""
+        names = set(names)
+        data = self._load()
+        if data.get("snapshots") is None:
+            return
+        data["snapshots"] = [fields for fields in data["snapshots"] if fields[0] not in names]
+        self._save()
+
+
+    def invalidate(self):
+        """Mark the catalog as stale, so the next read refreshes it"""
+        data = self._load()
+        if data.get("snapshots") is not None:
+            data["fetched_at"] = 0
+            self._save()
+
+
+    def repo_known(self):
+        """True if the repo was seen on the cluster less than `REPO_CHECK_TTL` seconds ago"""
+        return time.time() - self._load().get("repo_checked_at", 0) < REPO_CHECK_TTL
+
+
+    def mark_repo_known(self):
+        """Record that the repo exists on the cluster"""
+        self._load()["repo_checked_at"] = time.time()
+        self._save()
+
+
+    def _load(self):
+        if self._data is None:
+            try:
+                with open(self._path) as cache_file:
+                    self._data = json.load(cache_file)
+            except (OSError, ValueError):
+                self._data = {}
+        return self._data
+
+
+    def _save(self):
+        tmp_path = "{}.{}.tmp".format(self._path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            with open(tmp_path, "w") as cache_file:
+                json.dump(self._data, cache_file, separators=(",", ":"))
+            os.replace(tmp_path, self._path)
+        except OSError as err:
+            print("Cannot write snapshot catalog cache: {}".format(err), file=sys.stderr)
+
+
+def _fields(rec):
+    return [rec.name, rec.state, rec.start_time, rec.end_time, rec.version, rec.index_count]
@@ -1,10 +1,53 @@
 import sys
 import time
 import json
-from uuid import uuid4
+import re
 import requests
-from retrying import retry
-from urllib.parse import urljoin
+import urllib3
+from urllib.parse import urljoin, urlparse
+from lib.es.stream import iter_json_array
+from lib.es.retry import RetryPolicy, RETRY_STATUSES, breaker_for, retry_after
+from lib.es.defaults import DEFAULT_POOL_SIZE, DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT, \
+    DEFAULT_RETRIES, DEFAULT_MAX_BACKOFF
+
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+# Callables invoked after every request, see `add_request_hook`
+_request_hooks = []
+
+
+def add_request_hook(hook):
+    """Register a callable to be invoked after every request made by any client, with keyword
+    arguments method, path, status (None if no response was received), elapsed (seconds, backoff
+    included), bytes_in, bytes_out, retries and backoff (seconds slept before retries)"""
+    _request_hooks.append(hook)
+
+
+def remove_request_hook(hook):
+    _request_hooks.remove(hook)
+
+
+def _run_request_hooks(**stats):
+    for hook in _request_hooks:
+        hook(**stats)
+
+
+def _bytes_in(res):
+    """Returns number of body bytes received, as sent over the wire if possible"""
+    try:
+        return res.raw.tell()
+    except (AttributeError, TypeError):
+        return len(res.content)
+
+
+def _connect_failed(err):
+    """True if a `requests.exceptions.ConnectionError` happened before the request was sent"""
+    if isinstance(err, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(err.args[0], "reason", None) if err.args else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
 
 
 def _mk_headers():
@@ -17,50 +60,179 @@ def _mk_auth(user=None, password=None):
     on given options. Will return None if no auth-specific options are present"""
 
     if (user is not None and password is not None):
-        print("Using HTTP Basic auth")
+        print("Using HTTP Basic auth", file=sys.stderr)
         return requests.auth.HTTPBasicAuth(user, password)
     else:
         return None
 
 
+def _mk_session(pool_size=DEFAULT_POOL_SIZE):
+    """Returns a `requests.Session` keeping up to `pool_size` connections per host alive, so
+    consecutive requests reuse the TCP (and TLS) connection instead of doing a new handshake"""
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({
+        "Connection": "keep-alive",
+        "Accept-Encoding": "gzip, deflate",
+    })
+    return session
+
+
 class Client:
     """Base ES client implementation"""
 
-    def __init__(self, url, user=None, password=None):
+    def __init__(self, url, user=None, password=None, pool_size=DEFAULT_POOL_SIZE,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT,
+                 retries=DEFAULT_RETRIES, max_backoff=DEFAULT_MAX_BACKOFF):
         if url is None:
             raise Exception("Cluster URL must be provided")
         self._cluster_url = url
         self._auth = _mk_auth(user, password)
+        self._session = _mk_session(pool_size)
+        self._timeout = (connect_timeout, read_timeout)
+        self._version = None
+        self._retry = RetryPolicy(retries, max_backoff)
+        self._host = urlparse(url).netloc or url
+        self._breaker = breaker_for(self._host)
 
 
-    def do_request(self, method, path, payload=None, expected=200):
-        """Make a generic request"""
+    def close(self):
+        """Close all pooled connections"""
+        self._session.close()
+
+
+    def version(self):
+        """Returns the cluster's version as tuple of ints, e.g. (7, 10, 2)"""
+        if self._version is None:
+            data, _ = self.do_get("")
+            numbers = re.findall(r"\d+", data["version"]["number"])[:3]
+            self._version = tuple(int(n) for n in numbers)
+        return self._version
+
+
+    def do_request(self, method, path, payload=None, expected=200, params=None, timeout=None,
+                   retry=True):
+        """Make a generic request. `timeout` overrides the read timeout for this request only,
+        e.g. for calls the server is expected to hold open. Idempotent requests rejected by a
+        busy cluster are retried, see `_send`. Pass `retry=False` for requests which fail if
+        sent twice, e.g. starting a snapshot"""
         headers = _mk_headers()
         data = json.dumps(payload) if payload else None
         url = self._url_from(path)
+        timeout = self._timeout if timeout is None else (self._timeout[0], timeout)
+        method = method.upper()
 
-        res = requests.request(method, url, data=data, headers=headers, auth=self._auth)
+        started = time.monotonic()
+        stats = dict(retries=0, backoff=0.0)
+        res = None
+        try:
+            res = self._send(method, stats, lambda: self._session.request(
+                method, url, data=data, headers=headers, params=params, auth=self._auth,
+                timeout=timeout), retry)
+        finally:
+            if _request_hooks:
+                _run_request_hooks(
+                    method=method, path=path,
+                    status=res.status_code if res is not None else None,
+                    elapsed=time.monotonic() - started,
+                    bytes_in=_bytes_in(res) if res is not None else 0,
+                    bytes_out=len(data) if data else 0,
+                    **stats)
         return self._validate_response(res, expected)
 
 
-    def do_get(self, url, expected=200):
+    def do_stream(self, path, key=None, rest=None, params=None, expected=200):
+        """Make a GET request and generate the elements of the JSON array in the response while
+        it is downloaded, see `lib.es.stream.iter_json_array`"""
+        url = self._url_from(path)
+
+        started = time.monotonic()
+        stats = dict(retries=0, backoff=0.0)
+        res = None
+        try:
+            res = self._send("GET", stats, lambda: self._session.get(
+                url, headers=_mk_headers(), params=params, auth=self._auth,
+                timeout=self._timeout, stream=True))
+            with res:
+                self._check_status(res, expected)
+                yield from iter_json_array(res.iter_content(STREAM_CHUNK_SIZE), key, rest)
+        finally:
+            if _request_hooks:
+                _run_request_hooks(
+                    method="GET", path=path,
+                    status=res.status_code if res is not None else None,
+                    elapsed=time.monotonic() - started,
+                    bytes_in=_bytes_in(res) if res is not None else 0,
+                    bytes_out=0,
+                    **stats)
+
+
+    def _send(self, method, stats, send, retry=True):
+        """Send a request by calling `send`. Requests rejected with a backpressure status or
+        failing to connect are sent again as long as the retry policy allows, counting retries
+        and seconds slept in `stats`. Without `retry`, only requests which failed to connect,
+        and so never reached the cluster, are sent again. Fails fast while the host's circuit
+        breaker is open"""
+        delays = self._retry.delays()
+        while True:
+            self._breaker.check(self._host)
+            try:
+                res = send()
+            except requests.exceptions.ConnectionError as err:
+                if not _connect_failed(err):
+                    raise
+                opened = self._breaker.failure()
+                delay = next(delays, None)
+                if (opened or delay is None or
+                        not self._retry.should_retry(method, connect_error=True)):
+                    raise
+                print("Failed to connect to {}, retrying in {:.1f}s".format(self._host, delay),
+                      file=sys.stderr)
+            else:
+                if res.status_code not in RETRY_STATUSES:
+                    self._breaker.success()
+                    return res
+                opened = self._breaker.failure()
+                delay = next(delays, None)
+                if (opened or delay is None or not retry or
+                        not self._retry.should_retry(method, res.status_code)):
+                    return res
+                wait = retry_after(res)
+                if wait is not None:
+                    if wait > self._retry.max_backoff:
+                        return res
+                    delay = max(delay, wait)
+                res.close()
+                print("Cluster at {} responded {}, retrying in {:.1f}s".format(
+                    self._host, res.status_code, delay), file=sys.stderr)
+            time.sleep(delay)
+            stats["retries"] += 1
+            stats["backoff"] += delay
+
+
+    def do_get(self, url, expected=200, params=None, timeout=None):
         """Make a GET request"""
-        return self.do_request("get", url, expected=expected)
+        return self.do_request("get", url, expected=expected, params=params, timeout=timeout)
 
 
-    def do_put(self, url, payload=None, expected=200):
+    def do_put(self, url, payload=None, expected=200, params=None, timeout=None, retry=True):
         """Make a PUT request"""
-        return self.do_request("put", url, payload=payload, expected=expected)
+        return self.do_request("put", url, payload=payload, expected=expected, params=params,
+                               timeout=timeout, retry=retry)
 
 
-    def do_post(self, url, payload=None, expected=(200, 201)):
+    def do_post(self, url, payload=None, expected=(200, 201), params=None, timeout=None):
         """Make a POST request"""
-        return self.do_request("post", url, payload=payload, expected=expected)
+        return self.do_request("post", url, payload=payload, expected=expected, params=params,
+                               timeout=timeout)
 
 
-    def do_delete(self, url, expected=200):
+    def do_delete(self, url, expected=200, params=None, timeout=None):
         """Make a DELETE request"""
-        return self.do_request("delete", url, expected=expected)
+        return self.do_request("delete", url, expected=expected, params=params, timeout=timeout)
 
 
     def _url_from(self, path):
@@ -69,15 +241,23 @@ class Client:
 
 
     def _validate_response(self, res, expected=(200, 201)):
-        """Check if response status code is within expected values, if not raises an Exception"""
+        """Check if response status code is within expected values, if not raises an Exception.
+        Only the body of successful responses is decoded"""
 
         if expected is None:
             return res
+        self._check_status(res, expected)
+
+        if res.status_code >= 300:
+            return None, res
+        return res.json(), res
+
+
+    def _check_status(self, res, expected):
+        """Raise an Exception if the response status code is not within expected values"""
         if isinstance(expected, int):
             expected = [expected]
 
         if res.status_code not in expected:
             print(res.text, file=sys.stderr)
             raise Exception("Unexpected response status ("+str(res.status_code)+")")
-
-        return res.json(), res
@@ -1,16 +1,21 @@
 from lib.es.client import Client
-import json
+from lib.es.async_client import AsyncClient, DEFAULT_CONCURRENCY
+from lib.es import settings, shards
+from lib.es.nodestats import NodeSampler, DEFAULT_HISTORY
+import asyncio
 
-def new_cluster(url, user=None, password=None):
-    client = Client(url, user, password)
-    cluster = Cluster(client)
+def new_cluster(url, user=None, password=None, concurrency=DEFAULT_CONCURRENCY, **client_opts):
+    client = Client(url, user, password, **client_opts)
+    cluster = Cluster(client, concurrency)
     return cluster
     
 
 class Cluster:
 
-    def __init__(self, es_client):
+    def __init__(self, es_client, concurrency=DEFAULT_CONCURRENCY):
         self._client = es_client
+        self._concurrency = concurrency
+        self._async_client = None
 
     
     def status(self):
@@ -34,12 +39,76 @@ class Cluster:
         return data
 
 
-    def settings_get(self):
-        """Get cluster wide value"""
-        data, _ = self._client.do_get("/_cluster/settings")
+    def settings_get(self, flat=False):
+        """Get cluster wide value, with `flat` set keys are returned in dotted form"""
+        params = {"flat_settings": "true"} if flat else None
+        data, _ = self._client.do_get("/_cluster/settings", params=params)
         return data
 
 
+    def settings_plan(self, desired):
+        """Returns the `Change`s needed to reach the `desired` flat settings per scope, reading
+        the current settings once"""
+        current = self.settings_get(flat=True)
+        return settings.diff(current, desired)
+
+
+    def settings_apply(self, changes):
+        """Apply all changes with a single settings update"""
+        data, _ = self._client.do_put("/_cluster/settings", settings.payload(changes))
+        return data
+
+
+    def shard_report(self, top=shards.DEFAULT_TOP):
+        """Analyze how shards, bytes, disk and heap usage are spread across nodes, see
+        `lib.es.shards.analyze`. Shards are decoded into columns while they are downloaded"""
+        table = shards.ShardTable.from_rows(self._client.do_stream("_cat/shards", params={
+            "format": "json", "bytes": "b", "h": shards.SHARD_COLUMNS}))
+        allocation = list(self._client.do_stream("_cat/allocation", params={
+            "format": "json", "bytes": "b", "h": shards.ALLOCATION_COLUMNS}))
+        data, _ = self._client.do_get("_nodes/stats/jvm",
+                                      params={"filter_path": shards.HEAP_FILTER})
+        heap = dict((node["name"], node["jvm"]["mem"]["heap_used_percent"])
+                    for node in (data or {}).get("nodes", {}).values())
+        return shards.analyze(table, allocation, heap, self.settings_get(flat=True), top)
+
+
+    def node_sampler(self, history=DEFAULT_HISTORY):
+        """Returns a `NodeSampler` of this cluster's node stats, sharing its connection"""
+        return NodeSampler(self._client, history)
+
+
     def toggle_rebalancing(self, value):
         """Set cluster wide shard rebalancing to on or off"""
         return self.settings_set("cluster.routing.allocation.enable", value)
+
+
+    async def verify_repos_async(self, names):
+        """Verify several snapshot repositories concurrently. Returns a dict mapping each repo name
+        to the list of nodes it was verified on, or None if the repo does not exist"""
+
+        async def verify(name):
+            data, res = await self._async().do_post(
+                "_snapshot/{}/_verify".format(name), expected=(200, 404))
+            if res.status_code == 404:
+                return name, None
+            return name, sorted(node["name"] for node in data["nodes"].values())
+
+        results = await asyncio.gather(*[verify(name) for name in names])
+        return dict(results)
+
+
+    def close(self):
+        """Shut down the worker threads of the async client, if one was started. The ES client
+        is left open, it may be shared"""
+        if self._async_client is not None:
+            self._async_client.close()
+            self._async_client = None
+
+
+    def _async(self):
+        """Returns the async client sharing this cluster's connection pool"""
+        if self._async_client is None:
+            self._async_client = AsyncClient(self._client, self._concurrency)
+        return self._async_client
+
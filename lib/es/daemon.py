@@ -0,0 +1,186 @@
+"""In-process scheduler running snapshot, cleanup and health check jobs, with a small HTTP status
+endpoint"""
+
+import sys
+import json
+import time
+import random
+import threading
+import traceback
+from socketserver import ThreadingMixIn
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+class Job:
+    """A function run on a `lib.es.schedule.Cron` schedule, delayed by up to `jitter` seconds.
+    A run is skipped while the previous one is still in progress. Jobs sharing an `exclusive`
+    lock wait for each other instead of running at the same time"""
+
+    def __init__(self, name, schedule, func, jitter=0, exclusive=None):
+        self.name = name
+        self.schedule = schedule
+        self.func = func
+        self.jitter = jitter
+        self.exclusive = exclusive
+        self._lock = threading.Lock()
+        self.next_run = None
+        self.running = False
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+        self.last_start = None
+        self.last_duration = None
+        self.last_status = None
+        self.last_error = None
+
+
+    def plan(self, now):
+        """Set the time of the next run after `now`"""
+        self.next_run = self.schedule.next_after(now) + random.uniform(0, self.jitter)
+
+
+    def run(self):
+        """Run the job unless its previous run is still in progress"""
+        if not self._lock.acquire(blocking=False):
+            self.skipped += 1
+            print("Skipping {} run, previous run still in progress".format(self.name))
+            return
+        try:
+            if self.exclusive:
+                with self.exclusive:
+                    self._run()
+            else:
+                self._run()
+        finally:
+            self._lock.release()
+
+
+    def _run(self):
+        self.running = True
+        self.last_start = time.time()
+        started = time.monotonic()
+        try:
+            self.func()
+            self.last_status = "ok"
+            self.last_error = None
+        except Exception as e:
+            self.failures += 1
+            self.last_status = "failed"
+            self.last_error = str(e)
+            print("Job {} failed: {}".format(self.name, e), file=sys.stderr)
+            traceback.print_exc()
+        finally:
+            self.runs += 1
+            self.last_duration = time.monotonic() - started
+            self.running = False
+
+
+    def status(self):
+        return dict(
+            schedule=self.schedule.expression,
+            next_run=_iso(self.next_run),
+            running=self.running,
+            runs=self.runs,
+            failures=self.failures,
+            skipped=self.skipped,
+            last_start=_iso(self.last_start),
+            last_duration=round(self.last_duration, 3) if self.last_duration is not None else None,
+            last_status=self.last_status,
+            last_error=self.last_error)
+
+
+class Scheduler:
+    """Runs each due job on its own thread, so a long snapshot doesn't hold up health checks"""
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.started = None
+        self._stop = threading.Event()
+
+
+    def run(self):
+        """Run jobs until `stop` is called"""
+        self.started = time.time()
+        for job in self.jobs:
+            job.plan(self.started)
+            print("Scheduled {} ({}), next run at {}".format(
+                job.name, job.schedule.expression, _iso(job.next_run)))
+        while not self._stop.is_set():
+            job = min(self.jobs, key=lambda j: j.next_run)
+            if self._stop.wait(max(0, job.next_run - time.time())):
+                break
+            job.plan(time.time())
+            threading.Thread(target=job.run, name=job.name, daemon=True).start()
+
+
+    def stop(self):
+        self._stop.set()
+
+
+    def status(self):
+        return dict(
+            started=_iso(self.started),
+            uptime=round(time.time() - self.started, 3) if self.started else None,
+            jobs={job.name: job.status() for job in self.jobs})
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StatusServer:
+    """Serves the scheduler status as JSON on `/status`. `/healthz` answers as long as the daemon
+    is up and lists the jobs whose last run failed"""
+
+    def __init__(self, scheduler, host, port):
+        self._server = _ThreadingHTTPServer((host, port), _mk_handler(scheduler))
+
+
+    @property
+    def address(self):
+        return "{}:{}".format(*self._server.server_address[:2])
+
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def _mk_handler(scheduler):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            status = scheduler.status()
+            if self.path == "/status":
+                self._respond(200, status)
+            elif self.path == "/healthz":
+                failed = [name for name, job in status["jobs"].items()
+                          if job["last_status"] == "failed"]
+                self._respond(200, dict(failed=failed))
+            else:
+                self._respond(404, dict(error="not found"))
+
+        def _respond(self, code, body):
+            data = json.dumps(body, sort_keys=True, indent=2).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    return Handler
+
+
+def _iso(timestamp):
+    if timestamp is None:
+        return None
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(timestamp))
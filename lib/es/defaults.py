@@ -0,0 +1,12 @@
+"""Default connection settings, kept free of heavy imports so the CLI can show them in `--help`
+without loading the HTTP client"""
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 60
+DEFAULT_CONCURRENCY = 4
+# Seconds to wait for each cluster when querying many at once
+DEFAULT_CLUSTER_TIMEOUT = 10
+# Retries of idempotent requests rejected by a busy cluster, and the longest wait before one
+DEFAULT_RETRIES = 3
+DEFAULT_MAX_BACKOFF = 30
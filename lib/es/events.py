@@ -0,0 +1,51 @@
+"""Machine readable output of measurements: JSON lines events and Prometheus textfiles"""
+
+import json
+import os
+import sys
+import time
+
+
+class EventLog:
+    """Appends events as JSON lines to a file, or to stdout if the path is '-'"""
+
+    def __init__(self, path):
+        self._out = sys.stdout if path == "-" else open(path, "a")
+
+
+    def emit(self, event, **fields):
+        record = dict(event=event, timestamp=round(time.time(), 3))
+        record.update(fields)
+        self._out.write(json.dumps(record, sort_keys=True)+"\n")
+        self._out.flush()
+
+
+    def close(self):
+        if self._out is not sys.stdout:
+            self._out.close()
+
+
+def write_textfile(path, metrics, labels=None):
+    """Write gauges to a Prometheus textfile (e.g. for the node exporter's textfile collector).
+    `metrics` is a list of (name, help, value) tuples. The file is replaced atomically"""
+    label_str = ""
+    if labels:
+        label_str = "{"+",".join('{}="{}"'.format(key, _escape(value))
+                                 for key, value in sorted(labels.items()))+"}"
+
+    lines = []
+    for name, help_text, value in metrics:
+        if value is None:
+            continue
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} gauge".format(name))
+        lines.append("{}{} {}".format(name, label_str, value))
+
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "w") as textfile:
+        textfile.write("\n".join(lines)+"\n")
+    os.replace(tmp_path, path)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
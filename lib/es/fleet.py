@@ -0,0 +1,81 @@
+"""Run cluster level actions against many clusters concurrently"""
+
+import time
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from lib.es.client import Client
+from lib.es.cluster import Cluster
+from lib.es.defaults import DEFAULT_CONCURRENCY, DEFAULT_CLUSTER_TIMEOUT
+
+
+class Target:
+    """A cluster to query, `name` defaults to host and port of the url"""
+
+    __slots__ = ("name", "url")
+
+    def __init__(self, url, name=None):
+        self.url = url
+        self.name = name or urlparse(url).netloc or url
+
+
+class Result:
+    """Outcome of an action on one cluster, exactly one of `value` and `error` is set"""
+
+    __slots__ = ("target", "value", "error", "elapsed")
+
+    def __init__(self, target, value=None, error=None, elapsed=0.0):
+        self.target = target
+        self.value = value
+        self.error = error
+        self.elapsed = elapsed
+
+
+def load_inventory(path):
+    """Read targets from a file with one cluster per line, as `url` or `name url`. Empty lines and
+    lines starting with # are skipped"""
+    targets = []
+    with open(path) as f:
+        for num, line in enumerate(f, 1):
+            fields = line.split()
+            if not fields or fields[0].startswith("#"):
+                continue
+            if len(fields) > 2:
+                raise Exception("{}:{}: expected 'url' or 'name url'".format(path, num))
+            targets.append(Target(fields[-1], fields[0] if len(fields) == 2 else None))
+    return targets
+
+
+def fan_out(targets, action, concurrency=DEFAULT_CONCURRENCY, timeout=DEFAULT_CLUSTER_TIMEOUT,
+            user=None, password=None, **client_opts):
+    """Call `action` with a `Cluster` for each target on a pool of `concurrency` threads and
+    generate a `Result` per target as soon as it is done. `timeout` bounds connecting to and
+    each response from a cluster, so one unreachable cluster doesn't hold up the others. For the
+    same reason requests are not retried unless `retries` are passed in `client_opts`"""
+    client_opts.setdefault("retries", 0)
+
+    def call(target):
+        started = time.monotonic()
+        client = Client(target.url, user, password, connect_timeout=timeout,
+                        read_timeout=timeout, **client_opts)
+        try:
+            value = action(Cluster(client))
+            return Result(target, value=value, elapsed=time.monotonic() - started)
+        except Exception as e:
+            return Result(target, error=_describe(e), elapsed=time.monotonic() - started)
+        finally:
+            client.close()
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = [executor.submit(call, target) for target in targets]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def _describe(error):
+    """Short description of a failed call, without the nested urllib3 reprs"""
+    name = type(error).__name__
+    if name in ("ConnectTimeout", "ReadTimeout"):
+        return "timed out"
+    if name == "ConnectionError":
+        return "connection failed"
+    return str(error) or name
@@ -0,0 +1,134 @@
+"""Snapshots of changed indices only, tracked in a local state file"""
+
+import json
+import os
+
+
+# Take a snapshot of all indices after this many snapshots of changed indices only
+DEFAULT_FULL_EVERY = 24
+
+STATE_VERSION = 1
+
+# Highest sequence number per shard copy, any write to an index raises it
+SEQ_NO_FILTER = "indices.*.shards.*.seq_no.max_seq_no"
+
+
+def index_fingerprints(client):
+    """Returns a fingerprint per open index, which changes whenever documents are written to the
+    index: its uuid, doc counts, primary store size and the sum of the highest sequence number
+    of each shard, if the cluster tracks them"""
+    rows = client.do_stream("_cat/indices", params={
+        "format": "json",
+        "bytes": "b",
+        "h": "index,uuid,status,docs.count,docs.deleted,pri.store.size"})
+    fingerprints = {}
+    for row in rows:
+        if row["status"] != "open":
+            continue
+        fingerprints[row["index"]] = [row["uuid"], row["docs.count"], row["docs.deleted"],
+                                      row["pri.store.size"]]
+
+    data, res = client.do_get("_stats/docs", params={"level": "shards",
+                                                     "filter_path": SEQ_NO_FILTER},
+                              expected=(200, 400, 404))
+    indices = (data or {}).get("indices", {}) if res.status_code == 200 else {}
+    for name, stats in indices.items():
+        if name in fingerprints:
+            fingerprints[name].append(sum(
+                max((copy.get("seq_no", {}).get("max_seq_no", -1) for copy in copies),
+                    default=-1)
+                for copies in stats.get("shards", {}).values()))
+
+    return {name: ":".join(str(part) for part in parts) for name, parts in fingerprints.items()}
+
+
+class SnapshotState:
+    """Records per index its fingerprint when it was last snapshotted, and which snapshot holds
+    that copy. Stored as JSON with snapshot names listed once, oldest first, and each index
+    mapped to `[fingerprint, position of its snapshot]`.
+
+    A missing file is an empty state. Unlike the catalog cache, an unreadable file is an error:
+    cleanup relies on it to keep the snapshots still needed for a restore"""
+
+    def __init__(self, path):
+        self.path = path
+        self._snapshots = []
+        self._indices = {}
+        self._since_full = None
+        self._load()
+
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            raise Exception("Failed to read snapshot state {}: {}".format(self.path, e))
+        if data.get("version") != STATE_VERSION:
+            raise Exception("Unsupported snapshot state version in {}".format(self.path))
+        self._snapshots = data["snapshots"]
+        self._indices = {name: tuple(entry) for name, entry in data["indices"].items()}
+        self._since_full = data["since_full"]
+
+
+    def is_empty(self):
+        return not self._indices
+
+
+    def needs_full(self, full_every=DEFAULT_FULL_EVERY):
+        """True if there was no full snapshot yet or `full_every` snapshots were taken since"""
+        return self._since_full is None or self._since_full + 1 >= full_every
+
+
+    def changed(self, fingerprints):
+        """Returns the indices whose fingerprint differs from the recorded one, or which were
+        never snapshotted, in name order"""
+        return sorted(name for name, fingerprint in fingerprints.items()
+                      if self._indices.get(name, (None,))[0] != fingerprint)
+
+
+    def referenced(self):
+        """Returns the names of the snapshots holding the latest copy of some index"""
+        return set(self._snapshots[pos] for _, pos in self._indices.values())
+
+
+    def covering(self):
+        """Returns a list of (snapshot name, [index names]) holding the latest copy of every
+        index, oldest snapshot first"""
+        groups = {}
+        for name, (_, pos) in self._indices.items():
+            groups.setdefault(pos, []).append(name)
+        return [(self._snapshots[pos], sorted(groups[pos])) for pos in sorted(groups)]
+
+
+    def record(self, covered, fingerprints, full=False):
+        """Record that each snapshot in `covered` holds the indices it maps to. Indices missing
+        from `fingerprints` no longer exist and are dropped, as are snapshots no longer needed"""
+        indices = {name: (fp, self._snapshots[pos]) for name, (fp, pos) in self._indices.items()
+                   if name in fingerprints}
+        for snapshot, names in covered.items():
+            for name in names:
+                if name in fingerprints:
+                    indices[name] = (fingerprints[name], snapshot)
+
+        needed = set(snap for _, snap in indices.values())
+        order = [name for name in self._snapshots + sorted(covered) if name in needed]
+        positions = {name: pos for pos, name in enumerate(order)}
+        self._snapshots = order
+        self._indices = {name: (fp, positions[snap]) for name, (fp, snap) in indices.items()}
+        self._since_full = 0 if full else (self._since_full or 0) + 1
+
+
+    def save(self):
+        """Write the state atomically"""
+        data = dict(version=STATE_VERSION, since_full=self._since_full,
+                    snapshots=self._snapshots,
+                    indices={name: list(entry) for name, entry in sorted(self._indices.items())})
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        tmp = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(tmp, self.path)
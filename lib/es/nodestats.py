@@ -0,0 +1,103 @@
+"""Live per node load, as rates of the cumulative counters in `_nodes/stats`"""
+
+import time
+from array import array
+from collections import deque
+
+
+STATS_METRICS = "indices,jvm,thread_pool,fs"
+
+# Only the counters used below are sent by the server, node stats are large otherwise
+STATS_FILTER = ",".join("nodes.*." + path for path in (
+    "name",
+    "timestamp",
+    "indices.indexing.index_total",
+    "indices.search.query_total",
+    "indices.merges.total",
+    "jvm.gc.collectors.*.collection_time_in_millis",
+    "thread_pool.*.rejected",
+    "fs.io_stats.total.read_kilobytes",
+    "fs.io_stats.total.write_kilobytes",
+))
+
+# Per second rates computed for each node, in this order
+RATES = ("index", "search", "gc_ms", "rejected", "merges", "read_kb", "write_kb")
+
+DEFAULT_INTERVAL = 5
+# Samples kept for averages, an hour at the default interval
+DEFAULT_HISTORY = 720
+
+
+def counters(node):
+    """Returns the cumulative counters in a node's stats, in `RATES` order"""
+    indices = node.get("indices", {})
+    collectors = node.get("jvm", {}).get("gc", {}).get("collectors", {})
+    io = node.get("fs", {}).get("io_stats", {}).get("total", {})
+    return array("d", (
+        indices.get("indexing", {}).get("index_total", 0),
+        indices.get("search", {}).get("query_total", 0),
+        sum(gc.get("collection_time_in_millis", 0) for gc in collectors.values()),
+        sum(pool.get("rejected", 0) for pool in node.get("thread_pool", {}).values()),
+        indices.get("merges", {}).get("total", 0),
+        io.get("read_kilobytes", 0),
+        io.get("write_kilobytes", 0),
+    ))
+
+
+class NodeSampler:
+    """Samples node stats and computes per second rates against the previous sample, timed by
+    each node's own stats timestamp. Only the latest counters per node and the rates of the last
+    `history` samples are kept. A sample in the history is one flat array of floats, with the
+    tuple of node names shared between samples while the nodes stay the same"""
+
+    def __init__(self, es_client, history=DEFAULT_HISTORY):
+        self._client = es_client
+        self._previous = {}
+        self.history = deque(maxlen=history)
+
+
+    def sample(self):
+        """Returns a dict of node names to rates in `RATES` order. Nodes which joined since the
+        previous sample are left out until the next one. Counters reset by a node restart give
+        a rate of 0"""
+        data, _ = self._client.do_get("_nodes/stats/" + STATS_METRICS,
+                                      params={"filter_path": STATS_FILTER})
+        now = time.time()
+        current = {}
+        names = []
+        flat = array("d")
+        for node_id, node in sorted((data or {}).get("nodes", {}).items()):
+            timestamp = node.get("timestamp") or now * 1000
+            values = counters(node)
+            current[node_id] = (timestamp, values)
+            previous = self._previous.get(node_id)
+            if previous is None or timestamp <= previous[0]:
+                continue
+            elapsed = (timestamp - previous[0]) / 1000.0
+            names.append(node.get("name", node_id))
+            flat.extend(max(0.0, (value - before) / elapsed)
+                        for value, before in zip(values, previous[1]))
+
+        self._previous = current
+        if names:
+            names = tuple(names)
+            if self.history and self.history[-1][1] == names:
+                names = self.history[-1][1]
+            self.history.append((now, names, flat))
+        return _unflatten(names, flat)
+
+
+    def averages(self):
+        """Returns the cluster wide rates, summed over nodes, averaged over the samples kept"""
+        width = len(RATES)
+        totals = [0.0] * width
+        for _, _, flat in self.history:
+            for i in range(width):
+                totals[i] += sum(flat[i::width])
+        samples = len(self.history)
+        return [total / samples for total in totals] if samples else totals
+
+
+def _unflatten(names, flat):
+    width = len(RATES)
+    return dict((name, flat[i * width:(i + 1) * width]) for i, name in enumerate(names))
@@ -0,0 +1,111 @@
+"""Snapshots split into partitions of indices, taken concurrently and handled as one group"""
+
+import heapq
+import re
+from lib.es.records import SnapshotRecord
+
+
+# ES 7.9 added running several snapshots at the same time
+CONCURRENT_SNAPSHOTS_VERSION = (7, 9, 0)
+
+PARTITION_NAME = re.compile(r"^(?P<group>.+)\.p(?P<part>\d+)of(?P<count>\d+)$")
+
+# Group states by precedence, the worst state of any partition is the state of the group
+STATE_ORDER = ("FAILED", "INCOMPLETE", "IN_PROGRESS", "PARTIAL", "SUCCESS")
+
+
+def partition_name(group, part, count):
+    """Name of partition `part` (1 based) of `count` partitions of a snapshot group"""
+    return "{}.p{}of{}".format(group, part, count)
+
+
+def parse_partition(name):
+    """Returns (group, part, count) if name is that of a partition, else None"""
+    match = PARTITION_NAME.match(name)
+    if not match:
+        return None
+    return match.group("group"), int(match.group("part")), int(match.group("count"))
+
+
+def balance(sizes, count):
+    """Split indices into at most `count` partitions of about equal total size, largest index
+    first onto the partition with the smallest total so far. `sizes` maps index names to bytes.
+    Returns lists of index names, largest partition first"""
+    heap = [(0, i, []) for i in range(min(count, len(sizes)))]
+    for name in sorted(sizes, key=lambda name: (-sizes[name], name)):
+        total, i, names = heapq.heappop(heap)
+        names.append(name)
+        heapq.heappush(heap, (total + sizes[name], i, names))
+    return [sorted(names) for _, _, names in sorted(heap, reverse=True)]
+
+
+def group_records(records):
+    """Merge consecutive `SnapshotRecord`s of the partitions of a group into a single record
+    named after the group, with `partitions` set to the names of its partitions. Other records
+    are passed through"""
+    group = None
+    members = []
+    for record in records:
+        parsed = parse_partition(record.name)
+        key = parsed[0] if parsed else None
+        if members and key != group:
+            yield _merge(group, members)
+            members = []
+        if key is None:
+            yield record
+            continue
+        group = key
+        members.append((parsed[2], record))
+    if members:
+        yield _merge(group, members)
+
+
+def merge_infos(group, infos):
+    """Merge the infos of the partitions of a group, as returned by the snapshot API, into the
+    info of a single snapshot named after the group, with `partitions` holding their infos in
+    partition order"""
+    infos = sorted(infos, key=lambda info: parse_partition(info["snapshot"])[1])
+    indices = []
+    for info in infos:
+        indices.extend(info.get("indices", []))
+    merged = {
+        "snapshot": group,
+        "state": min((info["state"] for info in infos), key=_rank),
+        "indices": sorted(set(indices)),
+        "partitions": infos,
+        "shards": {},
+    }
+    start_times = [info["start_time"] for info in infos if info.get("start_time")]
+    if start_times:
+        merged["start_time"] = min(start_times)
+    starts = [info.get("start_time_in_millis") for info in infos]
+    ends = [info.get("end_time_in_millis") for info in infos]
+    if None not in starts and None not in ends:
+        merged["duration_in_millis"] = max(ends) - min(starts)
+    for info in infos:
+        for key, count in info.get("shards", {}).items():
+            merged["shards"][key] = merged["shards"].get(key, 0) + count
+    return merged
+
+
+def _merge(group, members):
+    count = members[0][0]
+    records = [record for _, record in members]
+    states = [record.state for record in records]
+    if len(records) < count:
+        states.append("INCOMPLETE")
+    end_times = [record.end_time for record in records]
+    index_counts = [record.index_count for record in records]
+    return SnapshotRecord(
+        name=group,
+        state=min(states, key=_rank),
+        start_time=min(record.start_time for record in records),
+        end_time=None if None in end_times else max(end_times),
+        version=records[0].version,
+        index_count=None if None in index_counts else sum(index_counts),
+        partitions=[record.name for record in
+                    sorted(records, key=lambda record: parse_partition(record.name)[1])])
+
+
+def _rank(state):
+    return STATE_ORDER.index(state) if state in STATE_ORDER else 0
@@ -0,0 +1,57 @@
+"""Helpers to wait for long running cluster operations"""
+
+import time
+
+
+# Callables invoked with the number of seconds slept, after every sleep in a poll loop
+_sleep_hooks = []
+
+
+def add_sleep_hook(hook):
+    _sleep_hooks.append(hook)
+
+
+def remove_sleep_hook(hook):
+    _sleep_hooks.remove(hook)
+
+
+class Deadline:
+    """Overall client side time limit for a wait. A timeout of None never expires"""
+
+    def __init__(self, timeout=None):
+        self._end = None if timeout is None else time.monotonic() + timeout
+
+
+    def remaining(self):
+        """Returns seconds left, or None if there is no deadline"""
+        if self._end is None:
+            return None
+        return max(0.0, self._end - time.monotonic())
+
+
+    def expired(self):
+        return self._end is not None and time.monotonic() >= self._end
+
+
+    def cap(self, seconds):
+        """Returns seconds, capped to the time left"""
+        remaining = self.remaining()
+        return seconds if remaining is None else min(seconds, remaining)
+
+
+def backoff(initial=1, maximum=30, factor=2):
+    """Generate exponentially growing delays, capped at maximum"""
+    delay = initial
+    while True:
+        yield delay
+        delay = min(delay * factor, maximum)
+
+
+def sleep(seconds, deadline=None):
+    """Sleep for the given seconds, but not past the deadline"""
+    if deadline is not None:
+        seconds = deadline.cap(seconds)
+    if seconds > 0:
+        time.sleep(seconds)
+        for hook in _sleep_hooks:
+            hook(seconds)
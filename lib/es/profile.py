@@ -0,0 +1,164 @@
+"""Per endpoint timing of requests made to the cluster"""
+
+import sys
+import json
+import math
+import threading
+import time
+from lib.es import client, poll
+
+
+# Path segments after which names are API keywords rather than user supplied names
+API_ROOTS = ["_cat", "_cluster", "_nodes", "_recovery", "_stats", "_tasks"]
+
+
+def endpoint_template(path):
+    """Returns the path with index, repository and snapshot names replaced by placeholders,
+    e.g. `_snapshot/backups/abc/_restore` -> `_snapshot/{repo}/{snapshot}/_restore`"""
+    segments = [s for s in path.split("?", 1)[0].split("/") if s]
+    if not segments:
+        return "/"
+    if segments[0] == "_snapshot":
+        placeholders = iter(["{repo}", "{snapshot}"])
+        return "/".join([segments[0]] + [
+            s if s.startswith("_") else next(placeholders, "{names}") for s in segments[1:]])
+    if segments[0] in API_ROOTS:
+        return "/".join(segments)
+    return "/".join(s if s.startswith("_") else ("{index}" if i == 0 else "{names}")
+                    for i, s in enumerate(segments))
+
+
+def _percentile(values, pct):
+    """Nearest rank percentile of sorted values"""
+    if not values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100.0 * len(values)))
+    return values[rank - 1]
+
+
+class _Endpoint:
+    """Stats for one method and endpoint template"""
+
+    __slots__ = ("latencies", "bytes_in", "bytes_out", "retries", "backoff", "errors",
+                 "statuses")
+
+    def __init__(self):
+        self.latencies = []
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.retries = 0
+        self.backoff = 0.0
+        self.errors = 0
+        self.statuses = {}
+
+
+class Profiler:
+    """Collects request and poll loop sleep timings while installed"""
+
+    def __init__(self):
+        self._endpoints = {}
+        self._slept = 0.0
+        # Hooks may run on worker threads, `+=` on shared counters is not atomic
+        self._lock = threading.Lock()
+        self._started = None
+        self._stopped = None
+
+
+    def install(self):
+        self._started = time.monotonic()
+        client.add_request_hook(self._on_request)
+        poll.add_sleep_hook(self._on_sleep)
+
+
+    def uninstall(self):
+        client.remove_request_hook(self._on_request)
+        poll.remove_sleep_hook(self._on_sleep)
+        self._stopped = time.monotonic()
+
+
+    def _on_request(self, method, path, status, elapsed, bytes_in, bytes_out, retries,
+                    backoff=0.0):
+        key = (method, endpoint_template(path))
+        with self._lock:
+            endpoint = self._endpoints.get(key)
+            if endpoint is None:
+                endpoint = self._endpoints[key] = _Endpoint()
+            endpoint.latencies.append(elapsed)
+            endpoint.bytes_in += bytes_in
+            endpoint.bytes_out += bytes_out
+            endpoint.retries += retries
+            endpoint.backoff += backoff
+            if status is None:
+                endpoint.errors += 1
+            else:
+                endpoint.statuses[status] = endpoint.statuses.get(status, 0) + 1
+
+
+    def _on_sleep(self, seconds):
+        with self._lock:
+            self._slept += seconds
+
+
+    def _wall_time(self):
+        if self._started is None:
+            return 0.0
+        return (self._stopped or time.monotonic()) - self._started
+
+
+    def to_dict(self):
+        with self._lock:
+            items = list(self._endpoints.items())
+        endpoints = []
+        for (method, template), endpoint in sorted(items,
+                                                   key=lambda item: -sum(item[1].latencies)):
+            latencies = sorted(endpoint.latencies)
+            endpoints.append(dict(
+                method=method,
+                endpoint=template,
+                count=len(latencies),
+                total=round(sum(latencies), 6),
+                p50=round(_percentile(latencies, 50), 6),
+                p95=round(_percentile(latencies, 95), 6),
+                max=round(latencies[-1], 6),
+                bytes_in=endpoint.bytes_in,
+                bytes_out=endpoint.bytes_out,
+                retries=endpoint.retries,
+                backoff=round(endpoint.backoff, 6),
+                errors=endpoint.errors,
+                statuses={str(k): v for k, v in sorted(endpoint.statuses.items())}))
+        return dict(wall_time=round(self._wall_time(), 6),
+                    sleep_time=round(self._slept, 6),
+                    endpoints=endpoints)
+
+
+    def print_summary(self, out=sys.stderr):
+        """Print a table of endpoints, slowest in total first"""
+        data = self.to_dict()
+        row = "{:<7} {:<40} {:>6} {:>9} {:>9} {:>9} {:>11} {:>11} {:>7}"
+        print(row.format("METHOD", "ENDPOINT", "COUNT", "P50", "P95", "MAX",
+                         "BYTES_IN", "BYTES_OUT", "RETRIES"), file=out)
+        for e in data["endpoints"]:
+            print(row.format(e["method"], e["endpoint"], e["count"],
+                             "{:.3f}s".format(e["p50"]), "{:.3f}s".format(e["p95"]),
+                             "{:.3f}s".format(e["max"]), e["bytes_in"], e["bytes_out"],
+                             e["retries"]), file=out)
+        requests = sum(e["count"] for e in data["endpoints"])
+        in_requests = sum(e["total"] for e in data["endpoints"])
+        retries = sum(e["retries"] for e in data["endpoints"])
+        backoff = sum(e["backoff"] for e in data["endpoints"])
+        print("requests: {}, time in requests: {:.3f}s, sleeping in poll loops: {:.3f}s, "
+              "wall time: {:.3f}s".format(requests, in_requests, data["sleep_time"],
+                                          data["wall_time"]), file=out)
+        if retries:
+            print("retries: {}, backing off from a busy cluster: {:.3f}s".format(
+                retries, backoff), file=out)
+
+
+    def dump(self, path):
+        """Write the summary as JSON to path, "-" for stdout"""
+        if path == "-":
+            json.dump(self.to_dict(), sys.stdout, indent=2)
+            print()
+            return
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
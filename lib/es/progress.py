@@ -0,0 +1,247 @@
+"""Progress reporting for long running snapshot operations"""
+
+import time
+from lib.es.events import write_textfile
+from lib.es.units import format_bytes, format_duration
+
+
+DEFAULT_INTERVAL = 10
+
+# Number of indices (or shards) listed with their throughput in a progress report
+TOP_INDICES = 5
+
+# Only the fields of `_recovery` responses needed to report progress
+RECOVERY_FILTER = ",".join("*.shards."+field for field in (
+    "id", "type", "start_time_in_millis", "target.name", "index.size.total_in_bytes",
+    "index.size.recovered_in_bytes", "index.files.total", "index.files.recovered"))
+
+# Seconds the cluster's clock may be behind ours
+CLOCK_SKEW = 60
+
+
+class RestoreMonitor:
+    """Samples active shard recoveries during a restore and prints bytes recovered, throughput
+    per node and index, files remaining and an ETA. Only recoveries from the snapshot count,
+    not replicas copied from their primaries"""
+
+    def __init__(self, es_client, interval=DEFAULT_INTERVAL):
+        self.interval = interval
+        self._client = es_client
+        self._started = time.monotonic()
+        # Recoveries started before are of earlier restores, allowing for the cluster's clock
+        # to be a bit behind
+        self._started_millis = int((time.time() - CLOCK_SKEW) * 1000)
+        # (index, shard, node) -> [recovered bytes, total bytes] of every shard seen so far
+        self._shards = {}
+        self._last_sample = None
+        self._last_recovered = 0
+        self._previous = {}
+
+
+    def report(self):
+        """Sample active recoveries and print progress since the previous report"""
+        active, files_remaining = self._sample(active_only=True)
+        now = time.monotonic()
+
+        # Shards no longer active are done
+        for key, progress in self._shards.items():
+            if key not in active:
+                progress[0] = progress[1]
+        self._shards.update(active)
+
+        recovered = sum(progress[0] for progress in self._shards.values())
+        total = sum(progress[1] for progress in self._shards.values())
+        elapsed = now - self._last_sample if self._last_sample else now - self._started
+        rate = (recovered - self._last_recovered) / elapsed if elapsed > 0 else 0
+
+        eta = format_duration((total - recovered) / rate) if rate > 0 else "unknown"
+        print("Restore progress: {} of {} ({:.1f}%), {}/s, {} files remaining, ETA {}".format(
+            format_bytes(recovered), format_bytes(total),
+            100.0 * recovered / total if total else 0, format_bytes(rate),
+            files_remaining, eta))
+        if self._last_sample:
+            self._print_rates(active, elapsed)
+
+        self._last_sample = now
+        self._last_recovered = recovered
+        self._previous = active
+
+
+    def summary(self):
+        """Print total wall time and average throughput of the restore. Recoveries are sampled
+        once more, including finished ones, so restores shorter than the interval count too"""
+        elapsed = time.monotonic() - self._started
+        done, _ = self._sample(active_only=False)
+        self._shards.update(done)
+        recovered = sum(progress[1] for progress in self._shards.values())
+        print("Restore took {}, recovered {} ({}/s on average)".format(
+            format_duration(elapsed), format_bytes(recovered),
+            format_bytes(recovered / elapsed if elapsed > 0 else 0)))
+
+
+    def _sample(self, active_only):
+        """Returns recovered and total bytes per (index, shard, node) of the snapshot recoveries
+        started since the monitor was created, and the number of files remaining"""
+        params = {"filter_path": RECOVERY_FILTER}
+        if active_only:
+            params["active_only"] = "true"
+        data, _ = self._client.do_get("_recovery", params=params)
+
+        shards = {}
+        files_remaining = 0
+        for index_name, index in (data or {}).items():
+            for shard in index.get("shards", []):
+                if shard.get("type") != "SNAPSHOT" or \
+                        shard.get("start_time_in_millis", self._started_millis) < \
+                        self._started_millis:
+                    continue
+                key = (index_name, shard["id"], shard.get("target", {}).get("name", "?"))
+                size = shard["index"]["size"]
+                files = shard["index"]["files"]
+                shards[key] = [size["recovered_in_bytes"], size["total_in_bytes"]]
+                files_remaining += files["total"] - files["recovered"]
+        return shards, files_remaining
+
+
+    def _print_rates(self, active, elapsed):
+        """Print throughput per node and the fastest indices since the previous sample"""
+        nodes = {}
+        indices = {}
+        for key, (recovered, _) in active.items():
+            before = self._previous.get(key, [0])[0]
+            delta = (recovered - before) / elapsed
+            index_name, _, node = key
+            nodes[node] = nodes.get(node, 0) + delta
+            indices[index_name] = indices.get(index_name, 0) + delta
+
+        for node, rate in sorted(nodes.items()):
+            print("  node {}: {}/s".format(node, format_bytes(rate)))
+        top = sorted(indices.items(), key=lambda item: item[1], reverse=True)[:TOP_INDICES]
+        for index_name, rate in top:
+            print("  index {}: {}/s".format(index_name, format_bytes(rate)))
+
+
+class SnapshotMonitor:
+    """Samples `_snapshot/<repo>/<name>/_status` while a snapshot runs and reports shards done,
+    bytes processed per index and shard, upload throughput and the slowest shards. Reports are
+    printed and, given an `EventLog`, emitted as events. `name` may list several snapshots
+    separated by commas, which are reported as one"""
+
+    def __init__(self, es_client, repo, name, interval=DEFAULT_INTERVAL, events=None):
+        self.interval = interval
+        self._client = es_client
+        self._repo = repo
+        self._name = name
+        self._events = events
+        self._started = time.monotonic()
+        self._last_sample = None
+        self._last_processed = 0
+        self.processed = 0
+        self.total = 0
+
+
+    def report(self):
+        """Sample snapshot status and print progress since the previous report"""
+        data, res = self._client.do_get(
+            "_snapshot/{}/{}/_status".format(self._repo, self._name), expected=(200, 404))
+        if res.status_code == 404 or not data["snapshots"]:
+            return # not started yet
+        now = time.monotonic()
+
+        self.processed, self.total = 0, 0
+        done, failed, total_shards = 0, 0, 0
+        indices = {}
+        active = []
+        for status in data["snapshots"]:
+            processed, total = _snapshot_bytes(status.get("stats", {}))
+            self.processed += processed
+            self.total += total
+            shards = status.get("shards_stats", {})
+            done += shards.get("done", 0)
+            failed += shards.get("failed", 0)
+            total_shards += shards.get("total", 0)
+
+            for index_name, index in status.get("indices", {}).items():
+                indices[index_name] = _snapshot_bytes(index.get("stats", {}))
+                for shard_id, shard in index.get("shards", {}).items():
+                    if shard.get("stage") == "DONE":
+                        continue
+                    processed, total = _snapshot_bytes(shard.get("stats", {}))
+                    active.append(dict(
+                        index=index_name, shard=int(shard_id), stage=shard.get("stage"),
+                        node=shard.get("node"), processed_bytes=processed, total_bytes=total,
+                        time_ms=shard.get("stats", {}).get("time_in_millis", 0)))
+
+        elapsed = now - (self._last_sample or self._started)
+        rate = (self.processed - self._last_processed) / elapsed if elapsed > 0 else 0
+        print("Snapshot progress: {} of {} shards done, {} of {} ({}/s)".format(
+            done, total_shards, format_bytes(self.processed),
+            format_bytes(self.total), format_bytes(rate)))
+
+        slowest = sorted(active, key=lambda shard: shard["time_ms"], reverse=True)[:TOP_INDICES]
+        for shard in slowest:
+            print("  slow shard {}[{}] {} on {}: {} of {} in {}".format(
+                shard["index"], shard["shard"], shard["stage"], shard["node"],
+                format_bytes(shard["processed_bytes"]), format_bytes(shard["total_bytes"]),
+                format_duration(shard["time_ms"] / 1000.0)))
+
+        if self._events:
+            self._events.emit(
+                "snapshot_progress", repo=self._repo, snapshot=self._name,
+                shards_done=done, shards_failed=failed,
+                shards_total=total_shards, processed_bytes=self.processed,
+                total_bytes=self.total, bytes_per_sec=round(rate),
+                indices=dict((name, dict(processed_bytes=processed, total_bytes=total))
+                             for name, (processed, total) in indices.items()),
+                active_shards=active)
+
+        self._last_sample = now
+        self._last_processed = self.processed
+
+
+    def finish(self, state, info=None, prom_file=None):
+        """Print and record the outcome of the snapshot. `info` is the snapshot as returned by
+        the snapshot API, if available. Byte counts are those of the last sample, the status of
+        a completed snapshot is not fetched as that reads every shard's metadata from the repo"""
+        duration = time.monotonic() - self._started
+        if info and info.get("duration_in_millis") is not None:
+            duration = info["duration_in_millis"] / 1000.0
+        shards = (info or {}).get("shards", {})
+        rate = self.total / duration if duration > 0 and self.total else None
+
+        if rate:
+            print("Snapshot took {}, {} ({}/s on average)".format(
+                format_duration(duration), format_bytes(self.total), format_bytes(rate)))
+        else:
+            print("Snapshot took {}".format(format_duration(duration)))
+
+        if self._events:
+            self._events.emit(
+                "snapshot_done", repo=self._repo, snapshot=self._name, state=state,
+                duration_sec=round(duration, 3), total_bytes=self.total,
+                bytes_per_sec=round(rate) if rate else None,
+                shards_total=shards.get("total"), shards_failed=shards.get("failed"))
+
+        if prom_file:
+            write_textfile(prom_file, [
+                ("esctl_snapshot_success", "1 if the last snapshot succeeded",
+                 1 if state == "SUCCESS" else 0),
+                ("esctl_snapshot_duration_seconds", "Wall time of the last snapshot",
+                 round(duration, 3)),
+                ("esctl_snapshot_size_bytes", "Bytes covered by the last snapshot",
+                 self.total or None),
+                ("esctl_snapshot_throughput_bytes_per_second",
+                 "Average throughput of the last snapshot", round(rate) if rate else None),
+                ("esctl_snapshot_shards_total", "Shards in the last snapshot", shards.get("total")),
+                ("esctl_snapshot_shards_failed", "Failed shards in the last snapshot",
+                 shards.get("failed")),
+                ("esctl_snapshot_last_run_timestamp_seconds", "Time the last snapshot finished",
+                 int(time.time())),
+            ], labels={"repo": self._repo})
+
+
+def _snapshot_bytes(stats):
+    """Returns (processed, total) bytes from snapshot status stats of ES 7+ or older"""
+    if "processed" in stats:
+        return stats["processed"].get("size_in_bytes", 0), stats["total"].get("size_in_bytes", 0)
+    return stats.get("processed_size_in_bytes", 0), stats.get("total_size_in_bytes", 0)
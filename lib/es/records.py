@@ -0,0 +1,36 @@
+"""Compact records for items of large API responses"""
+
+
+class SnapshotRecord:
+    """A snapshot, holding only the fields the CLI uses. For a group of partitioned snapshots,
+    `partitions` lists the names of the snapshots in the group"""
+
+    __slots__ = ("name", "state", "start_time", "end_time", "version", "index_count",
+                 "partitions")
+
+    def __init__(self, name, state, start_time, end_time=None, version=None, index_count=None,
+                 partitions=None):
+        self.name = name
+        self.state = state
+        self.start_time = start_time
+        self.end_time = end_time
+        self.version = version
+        self.index_count = index_count
+        self.partitions = partitions
+
+
+    @classmethod
+    def from_dict(cls, data):
+        """Build record from a snapshot as returned by the snapshot API"""
+        indices = data.get("indices")
+        return cls(
+            name=data["snapshot"],
+            state=data.get("state"),
+            start_time=data.get("start_time"),
+            end_time=data.get("end_time"),
+            version=data.get("version"),
+            index_count=len(indices) if indices is not None else None)
+
+
+    def __repr__(self):
+        return "SnapshotRecord({!r}, {!r}, {!r})".format(self.name, self.state, self.start_time)
@@ -0,0 +1,120 @@
+"""Retries of requests rejected by a busy cluster, backing off and failing fast while a host keeps
+rejecting them"""
+
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from lib.es.defaults import DEFAULT_RETRIES, DEFAULT_MAX_BACKOFF
+
+
+# Statuses with which ES (or a proxy in front of it) signals backpressure or a missing master
+RETRY_STATUSES = (429, 502, 503, 504)
+
+# Methods which can safely be sent again. POSTs start restores, close indices etc. PUTs starting
+# snapshots are sent with `retry=False`, see `Client.do_request`
+IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "DELETE")
+
+# Consecutive rejected requests after which a host's breaker opens
+BREAKER_THRESHOLD = 5
+# Seconds an open breaker fails requests before letting one through to probe the host
+BREAKER_RESET_AFTER = 30
+
+BASE_DELAY = 0.5
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class RetryPolicy:
+    """Retry up to `retries` times, sleeping for decorrelated jittered delays between `BASE_DELAY`
+    and `max_backoff` seconds: each delay is random between the base and three times the
+    previous one, which spreads retries of many clients apart. A server's Retry-After is waited
+    for at least, but if it asks for more than `max_backoff` the request is not retried"""
+
+    def __init__(self, retries=DEFAULT_RETRIES, max_backoff=DEFAULT_MAX_BACKOFF):
+        self.retries = retries
+        self.max_backoff = max_backoff
+
+
+    def delays(self):
+        """Generate the delays before each retry"""
+        delay = BASE_DELAY
+        for _ in range(self.retries):
+            delay = min(self.max_backoff, random.uniform(BASE_DELAY, delay * 3))
+            yield delay
+
+
+    def should_retry(self, method, status=None, connect_error=False):
+        """Whether a request ending with `status`, or failing to connect, may be sent again"""
+        if self.retries <= 0 or method not in IDEMPOTENT_METHODS:
+            return False
+        return connect_error or status in RETRY_STATUSES
+
+
+class CircuitBreaker:
+    """Counts consecutive rejected requests to a host. After `threshold` of them requests fail
+    fast for `reset_after` seconds, then one request may probe whether the host recovered"""
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, reset_after=BREAKER_RESET_AFTER):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self._failures = 0
+        self._opened = None
+        self._lock = threading.Lock()
+
+
+    def check(self, host):
+        """Raise `CircuitOpen` unless a request to the host may be sent"""
+        with self._lock:
+            if self._opened is None:
+                return
+            if time.monotonic() - self._opened < self.reset_after:
+                raise CircuitOpen("Cluster at {} keeps rejecting requests, not sending more for "
+                                  "{}s".format(host, self.reset_after))
+            # Half open, let this request through and re-open on failure
+            self._opened = None
+            self._failures = self.threshold - 1
+
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened = None
+
+
+    def failure(self):
+        """Count a rejected request, returns True if the breaker is open now"""
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.threshold:
+                self._opened = time.monotonic()
+            return self._opened is not None
+
+
+# One breaker per host, shared by all clients of this process
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker_for(host):
+    with _breakers_lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker()
+        return _breakers[host]
+
+
+def retry_after(res):
+    """Returns the seconds to wait the response's Retry-After header asks for, or None"""
+    value = res.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
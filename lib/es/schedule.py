@@ -0,0 +1,102 @@
+"""Cron style schedules"""
+
+from datetime import datetime, timedelta, timezone
+
+
+ALIASES = {
+    "@hourly": "0 * * * *",
+    "@daily": "0 0 * * *",
+    "@midnight": "0 0 * * *",
+    "@weekly": "0 0 * * 0",
+    "@monthly": "0 0 1 * *",
+}
+
+# (name, min, max) of the five cron fields
+FIELDS = [("minute", 0, 59), ("hour", 0, 23), ("day of month", 1, 31), ("month", 1, 12),
+          ("day of week", 0, 7)]
+
+# Longest time to search for a matching minute, e.g. for "0 0 30 2 *"
+MAX_SEARCH = timedelta(days=366 * 5)
+
+
+class Cron:
+    """A cron expression (`minute hour day-of-month month day-of-week`, with `*`, lists, ranges
+    and steps) or one of the aliases `@hourly`, `@daily`, `@weekly` and `@monthly`. Times are
+    in UTC. Like cron, a restricted day of month or day of week matches if either one does"""
+
+    def __init__(self, expression):
+        self.expression = expression
+        fields = ALIASES.get(expression.strip(), expression).split()
+        if len(fields) != len(FIELDS):
+            raise Exception("Invalid schedule '{}', expected 5 fields or one of {}".format(
+                expression, ", ".join(sorted(ALIASES))))
+        self._minutes, self._hours, self._days, self._months, self._weekdays = [
+            _parse_field(field, *spec) for field, spec in zip(fields, FIELDS)]
+        # Sunday is 0 or 7
+        if 7 in self._weekdays:
+            self._weekdays = self._weekdays | {0}
+        self._any_day = fields[2] == "*"
+        self._any_weekday = fields[4] == "*"
+
+
+    def next_after(self, timestamp):
+        """Returns the first matching time after `timestamp` as a unix timestamp"""
+        when = datetime.fromtimestamp(timestamp, timezone.utc).replace(second=0, microsecond=0)
+        when += timedelta(minutes=1)
+        limit = when + MAX_SEARCH
+        while when < limit:
+            if when.month not in self._months:
+                when = (when.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(when):
+                when = when.replace(hour=0, minute=0) + timedelta(days=1)
+            elif when.hour not in self._hours:
+                when = when.replace(minute=0) + timedelta(hours=1)
+            elif when.minute not in self._minutes:
+                when += timedelta(minutes=1)
+            else:
+                return when.timestamp()
+        raise Exception("Schedule '{}' never matches".format(self.expression))
+
+
+    def _day_matches(self, when):
+        day = when.day in self._days
+        # isoweekday is 1 (Monday) to 7 (Sunday), cron counts from 0 (Sunday)
+        weekday = when.isoweekday() % 7 in self._weekdays
+        if self._any_day or self._any_weekday:
+            return day and weekday
+        return day or weekday
+
+
+    def __repr__(self):
+        return "Cron({!r})".format(self.expression)
+
+
+def _parse_field(field, name, low, high):
+    """Returns the set of values matched by one cron field"""
+    values = set()
+    for part in field.split(","):
+        step = 1
+        if "/" in part:
+            part, step = part.split("/", 1)
+            step = _parse_int(step, name)
+            if step < 1:
+                raise Exception("Invalid step in {} field '{}'".format(name, field))
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start, end = [_parse_int(value, name) for value in part.split("-", 1)]
+        else:
+            start = _parse_int(part, name)
+            end = high if step > 1 else start
+        if start < low or end > high or start > end:
+            raise Exception("Invalid {} field '{}', values must be between {} and {}".format(
+                name, field, low, high))
+        values.update(range(start, end + 1, step))
+    return values
+
+
+def _parse_int(value, name):
+    try:
+        return int(value)
+    except ValueError:
+        raise Exception("Invalid {} value '{}'".format(name, value))
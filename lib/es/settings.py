@@ -0,0 +1,89 @@
+"""Cluster settings declared in a file, applied as the minimal set of changes"""
+
+import json
+
+SCOPES = ("persistent", "transient")
+
+
+class Change:
+    """A setting to change, `old` is None if it is not set yet and `new` is None to reset it"""
+
+    __slots__ = ("scope", "key", "old", "new")
+
+    def __init__(self, scope, key, old, new):
+        self.scope = scope
+        self.key = key
+        self.old = old
+        self.new = new
+
+
+def load_settings(path):
+    """Read desired settings from a JSON or, with PyYAML installed, YAML file. The file maps
+    `persistent` and/or `transient` to settings, nested or with dotted keys. A null value resets
+    the setting to its default. Returns flat settings per scope with values as ES returns them"""
+    with open(path) as f:
+        if path.endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError:
+                raise Exception("PyYAML is required to read {}, install it or use JSON".format(
+                    path))
+            data = yaml.safe_load(f)
+        else:
+            data = json.load(f)
+
+    if not isinstance(data, dict) or not data or set(data) - set(SCOPES):
+        raise Exception("Expected {} to map {} to settings".format(path, " and/or ".join(SCOPES)))
+    return {scope: flatten(data.get(scope) or {}) for scope in SCOPES}
+
+
+def flatten(settings, prefix=""):
+    """Returns nested settings as a dict of dotted keys to normalized values"""
+    flat = {}
+    for key, value in settings.items():
+        key = prefix + str(key)
+        if isinstance(value, dict):
+            flat.update(flatten(value, key + "."))
+        else:
+            flat[key] = _normalize(value)
+    return flat
+
+
+def diff(current, desired):
+    """Returns the `Change`s turning `current` into `desired` settings, both flat settings per
+    scope. Settings not mentioned in `desired` are left alone"""
+    changes = []
+    for scope in SCOPES:
+        existing = current.get(scope, {})
+        for key, value in sorted(desired.get(scope, {}).items()):
+            old = existing.get(key)
+            if old != value:
+                changes.append(Change(scope, key, old, value))
+    return changes
+
+
+def payload(changes):
+    """Returns the body of a single settings update applying all changes"""
+    body = {}
+    for change in changes:
+        body.setdefault(change.scope, {})[change.key] = change.new
+    return body
+
+
+def rollback(changes):
+    """Returns the settings undoing `changes`, in the format read by `load_settings`"""
+    undo = {}
+    for change in changes:
+        undo.setdefault(change.scope, {})[change.key] = change.old
+    return undo
+
+
+def _normalize(value):
+    """ES returns setting values as strings, or lists of strings"""
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (list, tuple)):
+        return [_normalize(item) for item in value]
+    return str(value)
@@ -0,0 +1,229 @@
+"""Shard balance analysis from `_cat/shards`, `_cat/allocation` and node heap stats"""
+
+import math
+from array import array
+from collections import Counter
+
+
+SHARD_COLUMNS = "index,prirep,state,store,node"
+ALLOCATION_COLUMNS = "node,disk.percent"
+HEAP_FILTER = "nodes.*.name,nodes.*.jvm.mem.heap_used_percent"
+
+DEFAULT_TOP = 10
+
+# A node holding this many times the mean shards or bytes counts as hot
+HOT_RATIO = 1.2
+# ES starts moving shards off a node above its default high disk watermark
+DISK_HIGH_WATERMARK = 90
+# Old gen collections get frequent above this heap usage
+HEAP_PRESSURE = 75
+
+UNASSIGNED = -1
+
+# Suggested commands are written as documented in the Readme, the docker image runs the same
+# script as its entrypoint
+COMMAND = "./main.py cluster"
+
+EXCLUDE_SETTING = "cluster.routing.allocation.exclude._name"
+
+
+class ShardTable:
+    """Shard copies as columns of integers, one row per copy. Index and node names are stored once
+    and referred to by position, so a table of 100k+ shards takes a few MB and is aggregated
+    by zipping columns rather than building a dict per shard"""
+
+    def __init__(self):
+        self.index_names = []
+        self.node_names = []
+        self._index_codes = {}
+        self._node_codes = {}
+        self.index = array("l")
+        self.node = array("l")
+        self.primary = array("b")
+        self.store = array("q")
+
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Build the table from `_cat/shards` rows with `SHARD_COLUMNS`, as they are decoded"""
+        table = cls()
+        for row in rows:
+            node = row.get("node")
+            if node and row.get("state") == "RELOCATING":
+                # "source -> address id target", the copy still counts on its source
+                node = node.split(" ", 1)[0]
+            table.add(row["index"], node, row["prirep"] == "p", int(row.get("store") or 0))
+        return table
+
+
+    def add(self, index, node, primary, store):
+        self.index.append(_intern(index, self._index_codes, self.index_names))
+        self.node.append(_intern(node, self._node_codes, self.node_names) if node else UNASSIGNED)
+        self.primary.append(primary)
+        self.store.append(store)
+
+
+    def __len__(self):
+        return len(self.index)
+
+
+    def per_node(self):
+        """Returns lists of copies, primaries and bytes per node code"""
+        count = len(self.node_names)
+        shards, primaries, store = [0] * count, [0] * count, [0] * count
+        for node, primary, size in zip(self.node, self.primary, self.store):
+            if node == UNASSIGNED:
+                continue
+            shards[node] += 1
+            primaries[node] += primary
+            store[node] += size
+        return shards, primaries, store
+
+
+    def per_index_node(self):
+        """Returns a `Counter` of copies per (index code, node code), unassigned copies under
+        node `UNASSIGNED`"""
+        return Counter(zip(self.index, self.node))
+
+
+    def store_of(self, cells):
+        """Returns the bytes held by each of the given (index code, node code) cells"""
+        store = dict((cell, 0) for cell in cells)
+        for cell, size in zip(zip(self.index, self.node), self.store):
+            if cell in store:
+                store[cell] += size
+        return store
+
+
+def _intern(name, codes, names):
+    code = codes.get(name)
+    if code is None:
+        code = codes[name] = len(names)
+        names.append(name)
+    return code
+
+
+def skew(values):
+    """Returns max/mean ratio and coefficient of variation of the values"""
+    if not values:
+        return dict(mean=0, max=0, ratio=0.0, cv=0.0)
+    mean = sum(values) / len(values)
+    stdev = math.sqrt(sum((v - mean) ** 2 for v in values) / len(values))
+    return dict(mean=round(mean, 1), max=max(values),
+                ratio=round(max(values) / mean, 2) if mean else 0.0,
+                cv=round(stdev / mean, 2) if mean else 0.0)
+
+
+def analyze(table, allocation, heap, settings, top=DEFAULT_TOP):
+    """Returns per node load, skew of shards and bytes across data nodes, the indices most
+    concentrated on a single node and suggested actions. `allocation` are `_cat/allocation`
+    rows, `heap` maps node names to heap used percent and `settings` are the flat cluster
+    settings"""
+
+    shards, primaries, store = table.per_node()
+    disk = {row["node"]: row.get("disk.percent") for row in allocation
+            if row["node"] != "UNASSIGNED"}
+    names = sorted(set(disk) | set(table.node_names))
+    codes = dict((name, code) for code, name in enumerate(table.node_names))
+
+    nodes = []
+    for name in names:
+        code = codes.get(name)
+        nodes.append(dict(
+            node=name,
+            shards=shards[code] if code is not None else 0,
+            primaries=primaries[code] if code is not None else 0,
+            bytes=store[code] if code is not None else 0,
+            disk_percent=int(disk[name]) if disk.get(name) is not None else None,
+            heap_percent=heap.get(name)))
+
+    shard_skew = skew([node["shards"] for node in nodes])
+    bytes_skew = skew([node["bytes"] for node in nodes])
+    for node in nodes:
+        reasons = []
+        if shard_skew["mean"] and node["shards"] > HOT_RATIO * shard_skew["mean"]:
+            reasons.append("shards")
+        if bytes_skew["mean"] and node["bytes"] > HOT_RATIO * bytes_skew["mean"]:
+            reasons.append("bytes")
+        if node["disk_percent"] is not None and node["disk_percent"] >= DISK_HIGH_WATERMARK:
+            reasons.append("disk")
+        if node["heap_percent"] is not None and node["heap_percent"] >= HEAP_PRESSURE:
+            reasons.append("heap")
+        node["hot"] = reasons
+
+    offenders = _offenders(table, len(nodes), top)
+    unassigned = table.node.count(UNASSIGNED)
+    return dict(
+        shards=len(table),
+        unassigned=unassigned,
+        nodes=nodes,
+        skew=dict(shards=shard_skew, bytes=bytes_skew),
+        offenders=offenders,
+        suggestions=_suggest(nodes, offenders, unassigned, shard_skew, bytes_skew, settings))
+
+
+def _offenders(table, node_count, top):
+    """Indices with more copies on one node than an even spread would put there, most bytes on
+    that node first"""
+    copies = Counter(table.index)
+    worst = {}
+    for (index, node), count in table.per_index_node().items():
+        if node != UNASSIGNED and count > worst.get(index, (0, None))[0]:
+            worst[index] = (count, node)
+
+    uneven = {}
+    for index, (count, node) in worst.items():
+        even = int(math.ceil(copies[index] / float(node_count))) if node_count else count
+        if count > even:
+            uneven[(index, node)] = (count, even)
+
+    offenders = []
+    for (index, node), size in table.store_of(uneven).items():
+        count, even = uneven[(index, node)]
+        offenders.append(dict(
+            index=table.index_names[index], node=table.node_names[node], shards=count,
+            bytes=size, copies=copies[index], even=even))
+    offenders.sort(key=lambda offender: (-offender["bytes"], offender["index"]))
+    return offenders[:top]
+
+
+def _suggest(nodes, offenders, unassigned, shard_skew, bytes_skew, settings):
+    """Returns suggested commands and requests, with the reason for each"""
+    suggestions = []
+    current = dict(settings.get("persistent", {}))
+    current.update(settings.get("transient", {}))
+
+    allocation = current.get("cluster.routing.allocation.enable", "all")
+    if allocation != "all" and unassigned:
+        suggestions.append(dict(
+            reason="{} unassigned shard(s) while allocation is '{}'".format(unassigned, allocation),
+            action="{} rebalance --url $URL --value all".format(COMMAND)))
+
+    skewed = max(shard_skew["ratio"], bytes_skew["ratio"]) > HOT_RATIO
+    rebalance = current.get("cluster.routing.rebalance.enable", "all")
+    if skewed and rebalance != "all":
+        suggestions.append(dict(
+            reason="load is skewed while rebalancing is '{}'".format(rebalance),
+            action="{} set --url $URL --key cluster.routing.rebalance.enable "
+                   "--value all".format(COMMAND)))
+
+    full = [node for node in nodes if "disk" in node["hot"]]
+    if full:
+        # The setting replaces the whole list, keep nodes which are excluded already
+        excluded = [name for name in current.get(EXCLUDE_SETTING, "").split(",") if name]
+        excluded += [node["node"] for node in full if node["node"] not in excluded]
+        suggestions.append(dict(
+            reason="disk above {}% on {}, moving all their shards to other nodes".format(
+                DISK_HIGH_WATERMARK, ", ".join("{} ({}%)".format(node["node"], node["disk_percent"])
+                                               for node in full)),
+            action="{} set --url $URL --key {} --value {}".format(
+                COMMAND, EXCLUDE_SETTING, ",".join(excluded))))
+
+    for offender in offenders:
+        # One above the even spread, so losing a node doesn't leave copies unassigned
+        suggestions.append(dict(
+            reason="{} has {} of {} copies on {}".format(
+                offender["index"], offender["shards"], offender["copies"], offender["node"]),
+            action="PUT {}/_settings {{\"index.routing.allocation.total_shards_per_node\": "
+                   "{}}}".format(offender["index"], offender["even"] + 1)))
+    return suggestions
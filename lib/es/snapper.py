@@ -1,17 +1,78 @@
 """Module implements a class to make snapshot requests against the Elasticsearch API"""
 
-import sys
 import time
-import json
+import asyncio
+import functools
+import itertools
+import fnmatch
+import re
+import sys
+import threading
 from uuid import uuid4
 import requests
-from retrying import retry
-from lib.es.client import Client
+from lib.es.client import Client, _connect_failed
+from lib.es.async_client import AsyncClient, DEFAULT_CONCURRENCY, run
+from lib.es.poll import Deadline, backoff, sleep
+from lib.es.records import SnapshotRecord
+from lib.es.catalog import CatalogCache, DEFAULT_TTL
+from lib.es.cluster import Cluster
+from lib.es.settings import Change
+from lib.es.progress import RestoreMonitor, SnapshotMonitor, DEFAULT_INTERVAL
+from lib.es.incremental import SnapshotState, index_fingerprints, DEFAULT_FULL_EVERY
+from lib.es.partitions import CONCURRENT_SNAPSHOTS_VERSION, balance, group_records, \
+    merge_infos, partition_name
+
+
+# ES rejects request lines longer than `http.max_initial_line_length` (4kb by default), leave some
+# room for the cluster url, endpoint and query string when joining names into a url
+MAX_URL_NAMES_LENGTH = 3072
+
+# Longest time a single `_cluster/health` call is asked to block server side
+HEALTH_LONG_POLL = 30
+
+# Longest time to block on a `wait_for_completion` snapshot request before falling back to polling
+SNAPSHOT_LONG_POLL = 3600
+
+# Snapshot fields needed to list and order snapshots
+SNAPSHOT_FIELDS = ("snapshot", "state", "start_time", "end_time", "version")
+
+# ES 7.14 added `sort`, `size` and `after` to the get snapshots API
+PAGINATION_VERSION = (7, 14, 0)
+DEFAULT_PAGE_SIZE = 500
+INCREMENTAL_PAGE_SIZE = 20
+
+# ES 7.8 added deleting several snapshots with a single request
+BULK_DELETE_VERSION = (7, 8, 0)
+
+# Seconds a DELETE request is given per snapshot deleted with it, but at least `DELETE_TIMEOUT`
+DELETE_TIMEOUT = 60
+DELETE_TIMEOUT_PER_SNAPSHOT = 5
+
+# Transient cluster settings raised while a fast restore runs
+FAST_RESTORE_CLUSTER_SETTINGS = {
+    "indices.recovery.max_bytes_per_sec": "500mb",
+    "cluster.routing.allocation.node_concurrent_recoveries": 6,
+    "cluster.routing.allocation.node_initial_primaries_recoveries": 8,
+}
+
+# Settings of indices during a fast restore, until their primaries are active
+FAST_RESTORE_INDEX_SETTINGS = {
+    "index.number_of_replicas": 0,
+    "index.refresh_interval": "-1",
+}
 
+# Cluster health states, from worst to best
+HEALTH_STATES = ("red", "yellow", "green")
 
-def new_snapper(url, repo, bucket, region, user, password):
-    client = Client(url, user, password)
-    snapper = Snapper(client, repo, bucket, region)
+
+def new_snapper(url, repo, bucket, region, user, password, concurrency=DEFAULT_CONCURRENCY,
+                use_cache=True, cache_ttl=DEFAULT_TTL, skip_repo_check=False,
+                progress_interval=DEFAULT_INTERVAL, state_file=None, **client_opts):
+    client = Client(url, user, password, **client_opts)
+    cache = CatalogCache(url, repo, cache_ttl) if use_cache else None
+    state = SnapshotState(state_file) if state_file else None
+    snapper = Snapper(client, repo, bucket, region, concurrency, cache, skip_repo_check,
+                      progress_interval, state)
     return snapper
 
 
@@ -19,43 +80,540 @@ class Snapper:
     """Tool to manage snapshots on an ES cluster"""
 
 
-    def __init__(self, es_client, repo="snapper-snapshots", bucket=None, region=None):
+    def __init__(self, es_client, repo="snapper-snapshots", bucket=None, region=None,
+                 concurrency=DEFAULT_CONCURRENCY, cache=None, skip_repo_check=False,
+                 progress_interval=None, state=None):
         self._client = es_client
         self._repo_name = repo
         self._bucket_name = bucket
         self._region = region
+        self._concurrency = concurrency
+        self._async_client = None
+        self._cache = cache
+        self._repo_checked = skip_repo_check
+        self._progress_interval = progress_interval
+        self._state = state
 
 
-    def snapshot(self):
-        """Do a snapshot"""
+    def snapshot(self, timeout=None, events=None, prom_file=None, changed_only=False,
+                 full_every=DEFAULT_FULL_EVERY, partitions=1):
+        """Do a snapshot, waiting at most `timeout` seconds for it to complete. Progress is
+        reported every `progress_interval` seconds, and emitted to the `EventLog` if given.
+        Stats of the finished snapshot are written to the Prometheus textfile `prom_file`.
+        With `changed_only` set, only indices changed since they were last snapshotted are
+        included, and every `full_every`th snapshot includes all, see `_changed_indices`.
+        With `partitions` above 1, the indices are split into that many snapshots of about
+        equal size which run concurrently, see `_plan_partitions`"""
 
         name = str(uuid4())
-        snapshot_url = "_snapshot/{}/{}".format(self._repo_name, name)
+        deadline = Deadline(timeout)
 
         self._ensure_repo()
 
-        # PUT snapshot url creates the snapshot
-        print("Snapshot url: "+snapshot_url)
-        self._client.do_put(snapshot_url)
+        indices = None
+        if changed_only:
+            fingerprints, indices = self._changed_indices(full_every)
+            if indices is not None and not indices:
+                print("No indices changed since the last snapshot, skipping")
+                return
 
-        # Poll snapshot state and wait until it changes to 'SUCCESS'
+        if partitions > 1:
+            parts = self._plan_partitions(name, indices, partitions)
+        else:
+            parts = {name: indices}
+        names = list(parts)
+
+        monitor = SnapshotMonitor(
+            self._client, self._repo_name, ",".join(names), self._progress_interval, events)
+        snapshot_url = self._snapshot_url(",".join(names))
+        print("Snapshot url: "+snapshot_url)
         print("Waiting for snapshot to complete ...")
+        if len(names) == 1:
+            payload = None
+            if indices is not None:
+                payload = {"indices": ",".join(indices), "ignore_unavailable": True}
+            infos = [self._create_snapshot(snapshot_url, deadline, monitor, payload)]
+        else:
+            infos = self._start_partitions(parts)
+
+        if self._cache:
+            self._cache.invalidate()
+
+        infos = self._wait_for_snapshots(names, infos, deadline, monitor, prom_file)
+        info = infos[0] if len(infos) == 1 else merge_infos(name, infos)
+
+        monitor.finish(info["state"], info, prom_file)
+        if info["state"] != "SUCCESS":
+            raise Exception("Unexpected snapshot state: "+info["state"])
+        print("Snapshot complete: "+snapshot_url)
+
+        if changed_only:
+            covered = dict((part["snapshot"], part["indices"]) for part in infos)
+            self._state.record(covered, fingerprints, full=indices is None)
+            self._state.save()
+
+
+    def _plan_partitions(self, group, indices, count):
+        """Returns a dict of partition snapshot names to the indices they hold, balanced by
+        primary store size. All open indices are partitioned unless `indices` are given. Falls
+        back to a single snapshot on clusters which can't run snapshots concurrently"""
+        if self._client.version() < CONCURRENT_SNAPSHOTS_VERSION:
+            print("Cluster can't run snapshots concurrently, taking a single snapshot")
+            return {group: indices}
+
+        rows = self._client.do_stream("_cat/indices", params={
+            "format": "json", "bytes": "b", "h": "index,status,pri.store.size"})
+        selected = set(indices) if indices is not None else None
+        sizes = dict((row["index"], int(row["pri.store.size"] or 0)) for row in rows
+                     if row["status"] == "open" and (selected is None or row["index"] in selected))
+        if len(sizes) < 2:
+            return {group: indices}
+
+        parts = balance(sizes, count)
+        names = [partition_name(group, i + 1, len(parts)) for i in range(len(parts))]
+        for name, part in zip(names, parts):
+            print("Partition {}: {} indices, {} bytes".format(
+                name, len(part), sum(sizes[index] for index in part)))
+        return dict(zip(names, parts))
+
+
+    def _start_partitions(self, parts):
+        """Start a snapshot per partition without waiting for them, returns their infos. Only
+        the first partition includes the cluster's global state. If a partition fails to
+        start, the ones already started are deleted, which aborts them"""
+        infos = []
+        try:
+            for i, (name, indices) in enumerate(parts.items()):
+                self._client.do_put(self._snapshot_url(name), {
+                    "indices": ",".join(indices),
+                    "ignore_unavailable": True,
+                    "include_global_state": i == 0,
+                }, retry=False)
+                infos.append({"snapshot": name, "state": "IN_PROGRESS"})
+        except Exception:
+            if infos:
+                self._abort_partitions([info["snapshot"] for info in infos])
+            raise
+        return infos
+
+
+    def _abort_partitions(self, names):
+        """Delete the given running partitions, so none is left behind untracked"""
+        print("Aborting {} partition(s) already started".format(len(names)), file=sys.stderr)
+        try:
+            self._client.do_delete(self._snapshot_url(",".join(names)), expected=(200, 404),
+                                   timeout=max(DELETE_TIMEOUT,
+                                               DELETE_TIMEOUT_PER_SNAPSHOT * len(names)))
+        except Exception as err:
+            print("Cannot delete partitions {}: {}".format(", ".join(names), err),
+                  file=sys.stderr)
+
+
+    def _wait_for_snapshots(self, names, infos, deadline, monitor, prom_file=None):
+        """Poll the snapshots until none of them is in progress, starting from their `infos`
+        as returned when they were created. Returns their final infos in order of `names`"""
+        url = self._snapshot_url(",".join(names))
+        delays = backoff()
+        while any(info["state"] == "IN_PROGRESS" for info in infos):
+            if deadline.expired():
+                monitor.finish("TIMED_OUT", prom_file=prom_file)
+                raise Exception("Timed out waiting for snapshot "+url)
+            sleep(min(next(delays), self._progress_interval or SNAPSHOT_LONG_POLL), deadline)
+            data, _ = self._client.do_get(url)
+            infos = sorted(data["snapshots"], key=lambda info: names.index(info["snapshot"]))
+            if self._progress_interval and any(info["state"] == "IN_PROGRESS" for info in infos):
+                _report(monitor.report)
+        return infos
+
+
+    def _changed_indices(self, full_every):
+        """Returns the fingerprints of all open indices, and the ones which changed since the
+        snapshot recorded in the state, or None if a full snapshot is due. A full snapshot is
+        also taken if a snapshot the state refers to was deleted"""
+        if self._state is None:
+            raise Exception("A state file is required to snapshot changed indices only")
+
+        fingerprints = index_fingerprints(self._client)
+        if self._state.needs_full(full_every):
+            print("Taking a full snapshot of {} indices".format(len(fingerprints)))
+            return fingerprints, None
+
+        existing = set(record.name for record in self.iter_snapshots())
+        missing = self._state.referenced() - existing
+        if missing:
+            print("Taking a full snapshot, {} snapshot(s) in the state file no longer "
+                  "exist".format(len(missing)))
+            return fingerprints, None
+
+        changed = self._state.changed(fingerprints)
+        print("{} of {} indices changed since they were last snapshotted".format(
+            len(changed), len(fingerprints)))
+        return fingerprints, changed
+
+
+    def _create_snapshot(self, snapshot_url, deadline, monitor, payload=None):
+        """PUT snapshot url to create the snapshot, the server holds the response until it is
+        done. Returns the snapshot info, whose state is IN_PROGRESS if the wait was cut off. With
+        a progress interval, the monitor reports progress while the request is pending, failing
+        reports are only warned about"""
+
+        if not self._progress_interval:
+            return self._put_snapshot(snapshot_url, deadline, payload)
+
+        result = {}
+
+        def put():
+            try:
+                result["info"] = self._put_snapshot(snapshot_url, deadline, payload)
+            except Exception as err:
+                result["error"] = err
+
+        worker = threading.Thread(target=put, daemon=True)
+        worker.start()
         while True:
-            data, _ = self._client.do_get(snapshot_url)
-            state = data["snapshots"][0]["state"]
+            worker.join(self._progress_interval)
+            if not worker.is_alive():
+                break
+            _report(monitor.report)
 
-            if state == "SUCCESS":
-                print("Snapshot complete: "+snapshot_url)
+        if "error" in result:
+            raise result["error"]
+        return result["info"]
+
+
+    def _put_snapshot(self, snapshot_url, deadline, payload=None):
+        try:
+            data, res = self._client.do_put(
+                snapshot_url,
+                payload,
+                params={"wait_for_completion": "true"},
+                expected=(200, 502, 504),
+                timeout=max(1, deadline.cap(SNAPSHOT_LONG_POLL)),
+                retry=False)
+            if res.status_code != 200:
+                # A proxy gave up waiting while the snapshot is still running, sending the
+                # request again would fail as the snapshot exists already. Poll its state
+                return {"state": "IN_PROGRESS"}
+            return data["snapshot"]
+        except requests.exceptions.ReadTimeout:
+            # Deadline hit while the snapshot is still running, fall back to polling its state
+            return {"state": "IN_PROGRESS"}
+        except requests.exceptions.ConnectionError as err:
+            # The snapshot was never started if the cluster could not be reached
+            if _connect_failed(err):
+                raise
+            # Connection dropped by a proxy after the request was sent, poll the snapshot's state
+            return {"state": "IN_PROGRESS"}
+
+
+    def restore(self, name="latest", ignore_missing=False, wait_for="green", timeout=None,
+                fast=False, indices=None, rename_pattern=None, rename_replacement=None,
+                include_global_state=False):
+        """Do a restore, waiting at most `timeout` seconds for the cluster to reach `wait_for`.
+        With `fast` set, indices are restored without replicas and refreshes and with raised
+        recovery limits, see `_fast_restore`. `indices` patterns select which indices of the
+        snapshot are restored, optionally renamed, see `_restore_plan`. With a state file, the
+        latest snapshot is restored from all snapshots holding the latest copy of an index, see
+        `_restore_from_state`"""
+
+        if self._restores_from_state(name):
+            self._restore_from_state(wait_for, Deadline(timeout), fast, indices, rename_pattern,
+                                     rename_replacement, include_global_state)
+            return
+
+        snapshot_info = self._find_snapshot(name, ignore_missing)
+        if not snapshot_info:
+            return
+        if snapshot_info.get("partitions"):
+            self._restore_group(snapshot_info, wait_for, Deadline(timeout), fast, indices,
+                                rename_pattern, rename_replacement, include_global_state)
+            return
+
+        payload, targets = self._restore_plan(
+            snapshot_info, indices, rename_pattern, rename_replacement, include_global_state)
+        original = self._index_settings(targets) if fast else None
+        self._close_indices(targets)
+        self._restore_and_wait(
+            snapshot_info["snapshot"], payload, wait_for, Deadline(timeout), original, targets)
+
+
+    async def restore_async(self, name="latest", ignore_missing=False, wait_for="green",
+                            timeout=None, fast=False, indices=None, rename_pattern=None,
+                            rename_replacement=None, include_global_state=False):
+        """Do a restore, closing the indices concurrently"""
+
+        if self._restores_from_state(name):
+            self._restore_from_state(wait_for, Deadline(timeout), fast, indices, rename_pattern,
+                                     rename_replacement, include_global_state)
+            return
+
+        snapshot_info = self._find_snapshot(name, ignore_missing)
+        if not snapshot_info:
+            return
+        if snapshot_info.get("partitions"):
+            self._restore_group(snapshot_info, wait_for, Deadline(timeout), fast, indices,
+                                rename_pattern, rename_replacement, include_global_state)
+            return
+
+        payload, targets = self._restore_plan(
+            snapshot_info, indices, rename_pattern, rename_replacement, include_global_state)
+        original = self._index_settings(targets) if fast else None
+        await self._close_indices_async(targets)
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, functools.partial(
+            self._restore_and_wait,
+            snapshot_info["snapshot"], payload, wait_for, Deadline(timeout), original, targets))
+
+
+    def _restores_from_state(self, name):
+        return name == "latest" and self._state is not None and not self._state.is_empty()
+
+
+    def _restore_from_state(self, wait_for, deadline, fast=False, patterns=None,
+                            rename_pattern=None, rename_replacement=None,
+                            include_global_state=False):
+        """Restore each index from the snapshot holding its latest copy according to the state
+        file, one snapshot after the other, oldest first. The global state is only restored
+        from the newest snapshot"""
+
+        self._ensure_repo()
+        repo_url = "_snapshot/{}".format(self._repo_name)
+        groups = self._state.covering()
+        if patterns:
+            groups = [(snapshot, _match_indices(names, patterns)) for snapshot, names in groups]
+            groups = [(snapshot, names) for snapshot, names in groups if names]
+            if not groups:
+                raise Exception("No indices in the state file match "+",".join(patterns))
+
+        print("Restoring {} indices from {} snapshot(s) in the state file".format(
+            sum(len(names) for _, names in groups), len(groups)))
+        parts = []
+        for snapshot, names in groups:
+            snapshot_info = self._get_snapshot(repo_url, snapshot)
+            if not snapshot_info:
+                raise Exception("Snapshot {} holding {} indices no longer exists".format(
+                    snapshot, len(names)))
+            parts.append((snapshot_info, names))
+        self._restore_parts(parts, wait_for, deadline, fast, rename_pattern, rename_replacement,
+                            groups[-1][0] if include_global_state else None)
+
+
+    def _restore_group(self, group_info, wait_for, deadline, fast=False, patterns=None,
+                       rename_pattern=None, rename_replacement=None, include_global_state=False):
+        """Restore a partitioned snapshot, one partition after the other. Only the first
+        partition holds the global state"""
+
+        parts = [(info, info["indices"]) for info in group_info["partitions"]]
+        if patterns:
+            parts = [(info, _match_indices(names, patterns)) for info, names in parts]
+            parts = [(info, names) for info, names in parts if names]
+            if not parts:
+                raise Exception("No indices in snapshot match "+",".join(patterns))
+
+        print("Restoring {} indices from {} partition(s)".format(
+            sum(len(names) for _, names in parts), len(parts)))
+        first = group_info["partitions"][0]["snapshot"]
+        self._restore_parts(parts, wait_for, deadline, fast, rename_pattern, rename_replacement,
+                            first if include_global_state else None)
+
+
+    def _restore_parts(self, parts, wait_for, deadline, fast=False, rename_pattern=None,
+                       rename_replacement=None, global_state_from=None):
+        """Restore the listed indices of each of `parts`, a list of (snapshot info, [index
+        names]), waiting for each restore before starting the next. The global state is only
+        restored from the snapshot named `global_state_from`"""
+        for snapshot_info, names in parts:
+            snapshot = snapshot_info["snapshot"]
+            print("Restoring {} indices from snapshot {} taken {}".format(
+                len(names), snapshot, snapshot_info["start_time"]))
+            payload, targets = self._restore_plan(
+                dict(snapshot_info, indices=names), None, rename_pattern, rename_replacement,
+                snapshot == global_state_from)
+            payload["indices"] = ",".join(names)
+            original = self._index_settings(targets) if fast else None
+            self._close_indices(targets)
+            self._restore_and_wait(snapshot, payload, wait_for, deadline, original, targets)
+
+
+    def list_snapshots(self, sort_reverse=False):
+        """List all snapshots, partitioned snapshots as one per group"""
+        return list(self.iter_snapshot_groups(newest_first=sort_reverse, with_indices=True))
+
+
+    def iter_snapshot_groups(self, newest_first=True, with_indices=False,
+                             page_size=DEFAULT_PAGE_SIZE):
+        """Generate snapshots like `iter_snapshots`, with the partitions of a partitioned
+        snapshot merged into one record for the group"""
+        return group_records(self.iter_snapshots(newest_first, with_indices, page_size))
+
+
+    def iter_snapshots(self, newest_first=True, with_indices=False, page_size=DEFAULT_PAGE_SIZE):
+        """Generate snapshots as `SnapshotRecord`s ordered by start time. Served from the catalog
+        cache if there is one, refreshing it as needed"""
+
+        if self._cache is None:
+            yield from self._fetch_snapshots(newest_first, with_indices, page_size)
+            return
+
+        records = self._cached_snapshots(with_indices)
+        yield from (reversed(records) if newest_first else records)
+
+
+    def _fetch_snapshots(self, newest_first=True, with_indices=False, page_size=DEFAULT_PAGE_SIZE):
+        """Generate snapshots as `SnapshotRecord`s ordered by start time. Responses are decoded
+        while they are downloaded. Unless `with_indices` is set, the indices of each snapshot are
+        filtered out by the server. Clusters supporting it are queried one page of `page_size`
+        snapshots at a time"""
+
+        self._ensure_repo()
+
+        fields = SNAPSHOT_FIELDS + (("indices",) if with_indices else ())
+        filter_path = ",".join("snapshots."+field for field in fields)
+        url = "_snapshot/{}/_all".format(self._repo_name)
+
+        if self._client.version() < PAGINATION_VERSION:
+            snaps = self._client.do_stream(url, key="snapshots", params={"filter_path": filter_path})
+            yield from sorted(
+                (SnapshotRecord.from_dict(snap) for snap in snaps),
+                key=lambda s: s.start_time,
+                reverse=newest_first
+            )
+            return
+
+        params = {
+            "filter_path": filter_path+",next",
+            "sort": "start_time",
+            "order": "desc" if newest_first else "asc",
+            "size": page_size,
+        }
+        while True:
+            rest = {}
+            for snap in self._client.do_stream(url, key="snapshots", rest=rest, params=params):
+                yield SnapshotRecord.from_dict(snap)
+            if not rest.get("next"):
                 break
-            elif state == "IN_PROGRESS":
-                time.sleep(2)
-                continue
-            else:
-                raise Exception("Unexpected snapshot state: "+state)
+            params["after"] = rest["next"]
+
+
+    def _cached_snapshots(self, with_indices=False):
+        """Returns the snapshot catalog from cache, oldest first. A stale catalog is refreshed
+        with just the snapshots newer than the newest cached one, if the cluster can list
+        snapshots newest first page by page. Index counts are only fetched with `with_indices`
+        set, a catalog cached without them is then fetched again completely"""
+
+        counted = not with_indices or all(
+            rec.index_count is not None for rec in self._cache.records() or [])
+        if self._cache.is_fresh() and counted:
+            return self._cache.records()
+
+        if not counted or self._cache.needs_full_refresh() or \
+                self._client.version() < PAGINATION_VERSION:
+            self._cache.store(self._fetch_snapshots(with_indices=with_indices), full=True)
+            return self._cache.records()
+
+        # Snapshots still running when cached need to be fetched again as well
+        done = set(rec.name for rec in self._cache.records() if rec.state != "IN_PROGRESS")
+        newer = []
+        recent = self._fetch_snapshots(newest_first=True, with_indices=with_indices,
+                                       page_size=INCREMENTAL_PAGE_SIZE)
+        for rec in recent:
+            if rec.name in done:
+                break
+            newer.append(rec)
+        self._cache.merge(newer)
+        return self._cache.records()
+
+
+    def cleanup(self, keep=5, dry_run=False):
+        """Cleanup old snapshots, see `cleanup_async`"""
+        try:
+            run(self.cleanup_async(keep, dry_run))
+        finally:
+            self.close()
+
+
+    async def cleanup_async(self, keep=5, dry_run=False):
+        """Cleanup old snapshots. Clusters supporting it delete a batch of snapshots per request,
+        older ones one snapshot per request. Requests are sent one at a time, a cluster runs a
+        single snapshot deletion at a time and rejects others. With `dry_run` set, only the
+        snapshots which would be deleted are printed"""
+        delete = self._expired_snapshots(keep)
+        start_times = dict((name, snap.start_time) for snap in delete
+                           for name in snap.partitions or [snap.name])
+
+        print("Cleaning up, will keep {} latest snapshot(s) and delete {}".format(keep, len(delete)))
+        if dry_run:
+            for snap in delete:
+                print("Would delete snapshot {} from {}".format(snap.name, snap.start_time))
+            return
+        if not delete:
+            return
+
+        bulk = self._client.version() >= BULK_DELETE_VERSION
+        if bulk:
+            batches = _chunk_names(list(start_times), MAX_URL_NAMES_LENGTH)
+        else:
+            batches = [[name] for name in start_times]
+        latencies = []
+
+        async def delete_batch(batch):
+            started = time.monotonic()
+            timeout = max(DELETE_TIMEOUT, DELETE_TIMEOUT_PER_SNAPSHOT * len(batch))
+            try:
+                _, res = await self._async().do_delete(self._snapshot_url(",".join(batch)),
+                                                       expected=(200, 404), timeout=timeout)
+                if res.status_code == 404 and len(batch) > 1:
+                    # A snapshot deleted elsewhere meanwhile fails the whole batch, delete one
+                    # by one
+                    for name in batch:
+                        await self._async().do_delete(self._snapshot_url(name),
+                                                      expected=(200, 404), timeout=timeout)
+            except requests.exceptions.ReadTimeout:
+                # The cluster keeps deleting after the request timed out
+                print("Deleting {} snapshot(s) takes over {}s, waiting for them to be gone".format(
+                    len(batch), timeout))
+                loop = asyncio.get_event_loop()
+                await loop.run_in_executor(None, self._wait_for_deleted, batch)
+            latencies.append(time.monotonic() - started)
+            if self._cache:
+                self._cache.remove(batch)
+            for name in batch:
+                print("Snapshot {} from {} deleted".format(name, start_times[name]))
+
+        started = time.monotonic()
+        for batch in batches:
+            await delete_batch(batch)
+        elapsed = time.monotonic() - started
+
+        print("Deleted {} snapshot(s) with {} request(s) in {:.1f}s ({:.2f} snapshots/s)".format(
+            len(start_times), len(batches), elapsed,
+            len(start_times) / elapsed if elapsed else 0))
+        print("Delete request latency: min {:.2f}s, avg {:.2f}s, max {:.2f}s".format(
+            min(latencies), sum(latencies) / len(latencies), max(latencies)))
+
+
+    def close(self):
+        """Shut down the worker threads of the async client, if one was started. The ES client
+        is left open, it may be shared"""
+        if self._async_client is not None:
+            self._async_client.close()
+            self._async_client = None
+
+
+    def _async(self):
+        """Returns the async client sharing this snapper's connection pool"""
+        if self._async_client is None:
+            self._async_client = AsyncClient(self._client, self._concurrency)
+        return self._async_client
+
+
+    def _snapshot_url(self, name):
+        return "_snapshot/{}/{}".format(self._repo_name, name)
 
 
-    def restore(self, name="latest", ignore_missing=False, wait_for="green"):
-        """Do a restore"""
+    def _find_snapshot(self, name, ignore_missing=False):
+        """Returns info on the snapshot to restore, the latest one if name is 'latest'. Returns
+        None if there is no such snapshot and `ignore_missing` is set"""
 
         # An existing S3 bucket might already hold snapshots we can use to restore
         # Check if snapshot repo already exists, if not, create it
@@ -68,65 +626,189 @@ class Snapper:
         if name == 'latest':
             snapshot_info = self._find_latest_snapshot()
         else:
-            snapshot_info = self._get_snapshot(repo_url, name)
+            snapshot_info = self._get_snapshot(repo_url, name) or self._get_group(repo_url, name)
 
         if not snapshot_info:
             if not ignore_missing:
                 raise Exception("No snapshots found")
             else:
                 print("No snapshot to restore, ignoring")
-                return
+                return None
+
+        print("Restoring snapshot "+snapshot_info["snapshot"]+" taken "+snapshot_info["start_time"])
+        return snapshot_info
+
 
-        snapshot_name = snapshot_info["snapshot"]
+    def _restore_plan(self, snapshot_info, patterns=None, rename_pattern=None,
+                      rename_replacement=None, include_global_state=False):
+        """Returns the restore request body and a dict mapping the names of the indices the
+        restore will write to, to the names of the snapshotted indices. `patterns` are matched against the indices in the snapshot like index
+        patterns in ES, a leading '-' excludes matches. `rename_pattern` is a regular expression
+        replaced by `rename_replacement` in restored index names, which may refer to groups as
+        $1, $2, ..."""
+
+        payload = {}
         indices = snapshot_info["indices"]
-        start_time = snapshot_info["start_time"]
+        if patterns:
+            indices = _match_indices(indices, patterns)
+            if not indices:
+                raise Exception("No indices in snapshot match "+",".join(patterns))
+            payload["indices"] = ",".join(indices)
+            print("Restoring {} of {} indices".format(len(indices), len(snapshot_info["indices"])))
+
+        targets = dict((name, name) for name in indices)
+        if rename_pattern:
+            if rename_replacement is None:
+                raise Exception("Value for `rename_replacement` is not provided")
+            payload["rename_pattern"] = rename_pattern
+            payload["rename_replacement"] = rename_replacement
+            targets = dict((_rename_index(name, rename_pattern, rename_replacement), name)
+                           for name in indices)
+
+        if include_global_state:
+            payload["include_global_state"] = True
+
+        return payload, targets
+
+
+    def _restore_snapshot(self, name, payload=None):
+        """Trigger the restore of the given snapshot"""
+        restore_url = "_snapshot/{}/{}/_restore".format(self._repo_name, name)
+        self._client.do_post(restore_url, payload or None)
+
+
+    def _restore_and_wait(self, name, payload, wait_for, deadline, original=None, targets=None):
+        """Restore snapshot and wait for the cluster to reach `wait_for`, reporting progress
+        every `progress_interval` seconds. Given the `original` replica and refresh settings of
+        the existing indices among `targets`, the fast restore profile is used"""
 
-        print("Restoring snapshot "+snapshot_name+" taken "+start_time)
-        self._close_indices(indices)
+        monitor = None
+        if self._progress_interval:
+            monitor = RestoreMonitor(self._client, self._progress_interval)
+
+        if original is None:
+            self._restore_snapshot(name, payload)
+            waited = self._wait_for(wait_for, deadline, monitor)
+        else:
+            waited = self._fast_restore(name, payload, wait_for, deadline, original, targets,
+                                        monitor)
+
+        if waited:
+            print("Done restoring from snapshot "+name)
+            if monitor:
+                _report(monitor.summary)
+
+
+    def _fast_restore(self, name, payload, wait_for, deadline, original, targets,
+                      monitor=None):
+        """Raise recovery limits and restore the existing indices among `targets` without
+        replicas and refreshes. Once their primaries are active, the `original` index settings
+        are put back, so replicas recover while the limits are still raised. Indices which did
+        not exist before are restored afterwards with the settings in the snapshot. Cluster
+        settings are reverted even if the restore fails"""
+
+        cluster = Cluster(self._client, self._concurrency)
+        created = [source for target, source in targets.items() if target not in original]
+        previous = cluster.settings_get(flat=True).get("transient", {})
+        try:
+            self._raise_recovery_limits(cluster, previous)
+            if original:
+                fast_payload = dict(payload, index_settings=FAST_RESTORE_INDEX_SETTINGS)
+                if created:
+                    fast_payload["indices"] = ",".join(targets[name] for name in original)
+                    payload = dict(payload, indices=",".join(created))
+                    payload.pop("include_global_state", None)
+                self._restore_snapshot(name, fast_payload)
+                try:
+                    print("Waiting for primaries to become active")
+                    self._wait_for_status("yellow", deadline, monitor)
+                finally:
+                    self._reset_index_settings(original)
+            if created or not original:
+                if original:
+                    print("Restoring {} indices which did not exist before".format(len(created)))
+                self._restore_snapshot(name, payload)
+            return self._wait_for(wait_for, deadline, monitor)
+        finally:
+            self._revert_recovery_limits(cluster, previous)
 
-        # restore snapshot
-        restore_url = "_snapshot/{}/{}/_restore".format(self._repo_name, snapshot_name)
-        self._client.do_post(restore_url)
 
+    def _wait_for(self, wait_for, deadline, monitor=None):
+        """Wait for cluster status `wait_for` unless it is 'red'. Returns whether it waited"""
         if wait_for == "red" or not wait_for:
-            return # no need to wait
+            return False # no need to wait
 
         print("Waiting for cluster to become "+wait_for)
-        self._wait_for_status(wait_for)
+        self._wait_for_status(wait_for, deadline, monitor)
+        return True
 
-        print("Done restoring from snapshot "+snapshot_name)
 
+    def _raise_recovery_limits(self, cluster, current):
+        """Set transient recovery limits for a fast restore with a single settings update,
+        given the `current` transient settings"""
+        changes = [Change("transient", key, current.get(key), value)
+                   for key, value in FAST_RESTORE_CLUSTER_SETTINGS.items()]
+        for change in changes:
+            print("Setting {} to {} during restore".format(change.key, change.new))
+        cluster.settings_apply(changes)
 
-    def list_snapshots(self, sort_reverse=False):
-        """List all snapshots"""
-
-        self._ensure_repo()
 
-        data, _ = self._client.do_get("_snapshot/{}/_all".format(self._repo_name))
+    def _revert_recovery_limits(self, cluster, previous):
+        """Reset recovery limits to the `previous` transient settings with a single settings
+        update, missing ones are reset to default"""
+        changes = [Change("transient", key, value, previous.get(key))
+                   for key, value in FAST_RESTORE_CLUSTER_SETTINGS.items()]
+        for change in changes:
+            print("Reverting {} to {}".format(
+                change.key, "default" if change.new is None else change.new))
+        cluster.settings_apply(changes)
 
-        sorted_snaps = sorted(
-            data["snapshots"],
-            key=lambda s: s["start_time"],
-            reverse=sort_reverse
-        )
 
-        return sorted_snaps
+    def _index_settings(self, indices):
+        """Returns replica and refresh settings of the given indices as a dict mapping index name
+        to a (number_of_replicas, refresh_interval) tuple. Settings which are not set explicitly
+        are reported as None, which resets them to default. Indices which do not exist are left
+        out"""
+        settings = {}
+        for batch in _chunk_names(list(indices), MAX_URL_NAMES_LENGTH):
+            data, _ = self._client.do_get(
+                ",".join(batch)+"/_settings/index.number_of_replicas,index.refresh_interval",
+                params={"flat_settings": "true", "ignore_unavailable": "true"})
+            for name, index in data.items():
+                index_settings = index["settings"]
+                settings[name] = (
+                    index_settings.get("index.number_of_replicas"),
+                    index_settings.get("index.refresh_interval"))
+        return settings
 
 
-    def cleanup(self, keep=5):
-        """Cleanup old snapshots"""
-        snaps = self.list_snapshots(sort_reverse=True)
-        delete = snaps[keep:]
+    def _reset_index_settings(self, original):
+        """Restore replica and refresh settings of restored indices, one request per batch of
+        indices sharing the same values"""
+        groups = {}
+        for name, values in original.items():
+            groups.setdefault(values, []).append(name)
 
-        print("Cleaning up, will keep {} latest snapshot(s)".format(keep))
-        for snap in delete:
-            self._delete_snapshot(snap["snapshot"])
-            print("Snapshot {} from {} deleted".format(snap["snapshot"], snap["start_time"]))
+        for (replicas, refresh_interval), names in groups.items():
+            payload = {
+                "index.number_of_replicas": replicas,
+                "index.refresh_interval": refresh_interval,
+            }
+            for batch in _chunk_names(names, MAX_URL_NAMES_LENGTH):
+                print("Resetting replicas and refresh interval of {} indices".format(len(batch)))
+                self._client.do_put(",".join(batch)+"/_settings", payload)
 
 
     def _ensure_repo(self):
         """Ensure the elasticsearch snapshot repo at the given url actually exists, if it doesn't,
-        create it"""
+        create it. Checked once per instance, or not at all if the cache has seen the repo
+        recently"""
+
+        if self._repo_checked:
+            return
+        if self._cache and self._cache.repo_known():
+            self._repo_checked = True
+            return
 
         repo_url = "_snapshot/{}".format(self._repo_name)
         _, res = self._client.do_get(repo_url, expected=(200, 404))
@@ -137,6 +819,10 @@ class Snapper:
         else:
             print("Snapshot repo '{}' already exists".format(self._repo_name))
 
+        self._repo_checked = True
+        if self._cache:
+            self._cache.mark_repo_known()
+
 
     def _create_repo(self, repo_url):
             if self._bucket_name is None:   
@@ -158,11 +844,38 @@ class Snapper:
     def _find_latest_snapshot(self):
         """Find the latest snapshot in the repo at the given url. Returns None if there are no
         snapshots."""
-        snapshots = self.list_snapshots(sort_reverse=True)
-        if not snapshots:
-            return None
-        else:
-            return snapshots[0]
+        repo_url = "_snapshot/{}".format(self._repo_name)
+        while True:
+            latest = next(self.iter_snapshot_groups(newest_first=True, page_size=1), None)
+            if not latest:
+                return None
+            if latest.partitions:
+                snapshot_info = self._get_group(repo_url, latest.name, latest.partitions)
+            else:
+                snapshot_info = self._get_snapshot(repo_url, latest.name)
+            if snapshot_info or not self._cache:
+                return snapshot_info
+            # Deleted since it was cached
+            self._cache.remove(latest.partitions or [latest.name])
+
+
+    def _expired_snapshots(self, keep):
+        """Returns all but the `keep` latest snapshots, without their indices. Snapshots the
+        state file still refers to are kept as well. The catalog is fetched from the cluster
+        rather than the cache, which may still hold snapshots deleted by other tools"""
+        snapshots = list(self._fetch_snapshots(newest_first=True))
+        if self._cache:
+            self._cache.store(snapshots, full=True)
+        expired = list(itertools.islice(group_records(snapshots), keep, None))
+        if self._state is None:
+            return expired
+        referenced = self._state.referenced()
+        kept = [snap for snap in expired
+                if referenced.intersection(snap.partitions or [snap.name])]
+        if kept:
+            print("Keeping {} snapshot(s) still holding the latest copy of some indices".format(
+                len(kept)))
+        return [snap for snap in expired if snap not in kept]
 
 
     def _get_snapshot(self, repo_url, name):
@@ -177,24 +890,153 @@ class Snapper:
             return data["snapshots"][0]
 
 
-    def _wait_for_status(self, expected_state="green"):
-        """Poll cluster health state and only terminate when given state is reached"""
+    def _get_group(self, repo_url, group, partitions=None):
+        """Find the partitions of a partitioned snapshot, all of them if `partitions` are not
+        given. Returns their merged info, see `merge_infos`, or None if there are none"""
+
+        url = repo_url+'/'+(",".join(partitions) if partitions else group+".p*")
+        data, res = self._client.do_get(url, expected=(200, 404))
+
+        if res.status_code == 404 or not data["snapshots"]:
+            return None
+        return merge_infos(group, data["snapshots"])
+
+
+    def _wait_for_status(self, expected_state="green", deadline=None, monitor=None):
+        """Wait until cluster health reaches the given state (or better). The server blocks each
+        health request until the state is reached or the long-poll timeout passes. The monitor,
+        if given, reports progress in between"""
+        deadline = deadline or Deadline()
+        long_poll = min(HEALTH_LONG_POLL, monitor.interval) if monitor else HEALTH_LONG_POLL
         while True:
-            data, _ = self._client.do_get("_cat/health")
-            if data[0]["status"] != expected_state:
-                time.sleep(5)
-            else:
-                break
+            wait = max(1, int(deadline.cap(long_poll)))
+            data, res = self._client.do_get(
+                "_cluster/health",
+                params={"wait_for_status": expected_state, "timeout": "{}s".format(wait)},
+                expected=(200, 400, 408),
+                timeout=wait + HEALTH_LONG_POLL)
+
+            if res.status_code == 400:
+                # Cluster does not understand the blocking health request
+                self._poll_for_status(expected_state, deadline, monitor)
+                return
+            if res.status_code == 200 and not data["timed_out"]:
+                return
+            if deadline.expired():
+                raise Exception("Timed out waiting for cluster to become "+expected_state)
+            if monitor:
+                _report(monitor.report)
+
+
+    def _poll_for_status(self, expected_state="green", deadline=None, monitor=None):
+        """Poll cluster health state with exponential backoff until given state (or better) is
+        reached"""
+        deadline = deadline or Deadline()
+        expected = HEALTH_STATES.index(expected_state)
+        delays = backoff()
+        while True:
+            data, _ = self._client.do_get("_cat/health", params={"format": "json"})
+            if HEALTH_STATES.index(data[0]["status"]) >= expected:
+                return
+            if deadline.expired():
+                raise Exception("Timed out waiting for cluster to become "+expected_state)
+            if monitor:
+                _report(monitor.report)
+            sleep(next(delays), deadline)
 
 
     def _close_indices(self, indices):
-        """Close list of indices on cluster at given url. If index does not exist it is ignored"""
-        for index_name in indices:
-            print("Closing index "+index_name)
-            self._client.do_post(index_name+"/_close", expected=(200, 404))
+        """Close list of indices on cluster at given url, a batch of indices per request. Indices
+        that do not exist or are already closed are skipped"""
+        for batch in self._close_batches(indices):
+            print("Closing {} indices ({} ... {})".format(len(batch), batch[0], batch[-1]))
+            self._client.do_post(
+                ",".join(batch)+"/_close",
+                params={"ignore_unavailable": "true"},
+                expected=(200, 404))
+
+
+    async def _close_indices_async(self, indices):
+        """Close list of indices, up to `concurrency` batches at a time"""
+
+        async def close_batch(batch):
+            print("Closing {} indices ({} ... {})".format(len(batch), batch[0], batch[-1]))
+            await self._async().do_post(
+                ",".join(batch)+"/_close",
+                params={"ignore_unavailable": "true"},
+                expected=(200, 404))
+
+        await asyncio.gather(*[close_batch(batch) for batch in self._close_batches(indices)])
+
+
+    def _close_batches(self, indices):
+        """Returns the open ones of the given indices, split into batches which fit into a
+        single request url"""
+        rows = self._client.do_stream("_cat/indices", params={"format": "json", "h": "index,status"})
+        open_indices = set(row["index"] for row in rows if row["status"] == "open")
+
+        to_close = [name for name in indices if name in open_indices]
+        skipped = len(indices) - len(to_close)
+        if skipped:
+            print("Skipping {} indices which are missing or already closed".format(skipped))
+
+        return _chunk_names(to_close, MAX_URL_NAMES_LENGTH)
+
+
+    def _wait_for_deleted(self, names):
+        """Poll until none of the named snapshots exist anymore"""
+        delays = backoff()
+        while True:
+            data, res = self._client.do_get(
+                self._snapshot_url(",".join(names)), expected=(200, 404),
+                params={"ignore_unavailable": "true", "filter_path": "snapshots.snapshot"})
+            if res.status_code == 404 or not (data or {}).get("snapshots"):
+                return
+            sleep(next(delays))
+
+
+
+def _report(report):
+    """Call a monitor's report method. Progress is best effort, a failure to sample it is only
+    warned about and the operation is waited for as before"""
+    try:
+        report()
+    except Exception as err:
+        print("Cannot report progress: {}".format(err), file=sys.stderr)
+
+
+def _chunk_names(names, max_length):
+    """Split names into lists whose comma-joined length does not exceed max_length"""
+    chunks = []
+    chunk = []
+    length = 0
+    for name in names:
+        added = len(name) + (1 if chunk else 0)
+        if chunk and length + added > max_length:
+            chunks.append(chunk)
+            chunk = []
+            added = len(name)
+            length = 0
+        chunk.append(name)
+        length += added
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def _match_indices(indices, patterns):
+    """Returns the indices matching the patterns in order, where a pattern with a leading '-'
+    removes the indices it matches from the ones selected so far"""
+    selected = set()
+    for pattern in patterns:
+        if pattern.startswith("-"):
+            selected -= set(fnmatch.filter(indices, pattern[1:]))
+        else:
+            selected |= set(fnmatch.filter(indices, pattern))
+    return [name for name in indices if name in selected]
+
 
+def _rename_index(name, pattern, replacement):
+    """Rename index like ES does on restore, translating Java style group references ($1)"""
+    return re.sub(pattern, re.sub(r"\$(\d+)", r"\\g<\1>", replacement), name)
 
-    def _delete_snapshot(self, name):
-        """Delete snapshot given by name"""
-        url = "_snapshot/{}/{}".format(self._repo_name, name)
-        self._client.do_delete(url)
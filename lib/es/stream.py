@@ -0,0 +1,122 @@
+"""Incremental decoding of large JSON responses"""
+
+import codecs
+import json
+
+
+_WHITESPACE = " \t\n\r"
+# Characters which may continue a number, e.g. after a chunk ending in `1.` or `1.5e`
+_NUMBER_CHARS = "0123456789.eE+-"
+_DECODER = json.JSONDecoder()
+
+
+def iter_json_array(chunks, key=None, rest=None):
+    """Decode a JSON array from an iterable of byte chunks and generate its elements one at a
+    time, so only a single element is held in memory. Without `key` the document must be an
+    array, otherwise the array is looked up under `key` in the top-level object. Other top-level
+    members are stored in `rest` if given"""
+
+    reader = _Reader(chunks)
+    if key is None:
+        reader.expect("[")
+        yield from reader.items()
+        return
+
+    reader.expect("{")
+    if reader.peek() == "}":
+        return
+    while True:
+        name = reader.value()
+        reader.expect(":")
+        if name == key and reader.peek() == "[":
+            reader.expect("[")
+            yield from reader.items()
+        else:
+            value = reader.value()
+            if rest is not None:
+                rest[name] = value
+        if reader.peek() == "}":
+            return
+        reader.expect(",")
+
+
+class _Reader:
+    """Cursor over text decoded from byte chunks, buffering only what is not consumed yet"""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+
+
+    def items(self):
+        """Generate the elements of an array whose opening bracket was consumed"""
+        if self.peek() == "]":
+            self._pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.peek() == "]":
+                self._pos += 1
+                return
+            self.expect(",")
+
+
+    def value(self):
+        """Decode the next complete JSON value"""
+        self.peek()
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # A number followed by nothing but number characters might continue in the next
+            # chunk, its valid prefix was decoded
+            if _is_number(value) and \
+                    all(char in _NUMBER_CHARS for char in self._buf[end:]) and self._fill():
+                continue
+            self._pos = end
+            return value
+
+
+    def peek(self):
+        """Returns the next non-whitespace character without consuming it"""
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON document")
+
+
+    def expect(self, char):
+        """Consume the next non-whitespace character, which must be `char`"""
+        found = self.peek()
+        if found != char:
+            raise ValueError("Expected '{}' in JSON document, found '{}'".format(char, found))
+        self._pos += 1
+
+
+    def _fill(self):
+        """Append the next chunk to the buffer, dropping consumed text. Returns False once all
+        chunks are read"""
+        while not self._eof:
+            try:
+                text = self._decoder.decode(next(self._chunks))
+            except StopIteration:
+                text = self._decoder.decode(b"", final=True)
+                self._eof = True
+            if text:
+                self._buf = self._buf[self._pos:] + text
+                self._pos = 0
+                return True
+        return False
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
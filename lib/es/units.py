@@ -0,0 +1,19 @@
+"""Human readable sizes and durations for command output"""
+
+
+def format_bytes(num):
+    """Format a number of bytes with a binary unit, e.g. 1.5 GB"""
+    for unit in ("B", "KB", "MB", "GB", "TB"):
+        if abs(num) < 1024 or unit == "TB":
+            return "{:.1f} {}".format(num, unit)
+        num /= 1024.0
+
+
+def format_duration(seconds):
+    """Format seconds as e.g. 1h05m, 3m20s or 42s"""
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return "{}h{:02d}m".format(seconds // 3600, seconds % 3600 // 60)
+    if seconds >= 60:
+        return "{}m{:02d}s".format(seconds // 60, seconds % 60)
+    return "{}s".format(seconds)
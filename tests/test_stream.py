@@ -0,0 +1,73 @@
+import json
+import random
+import unittest
+from lib.es.stream import iter_json_array
+
+
+DOCUMENTS = [
+    b'[]',
+    b'[1.5e3]',
+    b'[1.5, -2, 3e-2, 4E+10, 0.25, -0.0, 12345678901234567890]',
+    b'[true, false, null, "a,b", {"x": [1, 2.5]}, []]',
+    b' [ {"snapshot": "s-1", "state": "SUCCESS"} , {"snapshot": "s\\u00e9-2"} ] ',
+    '["café", "日本", 1.0]'.encode("utf-8"),
+]
+
+KEYED = b'{"total": 3.25, "snapshots": [{"n": 1e2}, {"n": -7}], "next": "abc", "count": 12}'
+
+
+def _split_at(data, offsets):
+    bounds = [0] + sorted(offsets) + [len(data)]
+    return [data[start:end] for start, end in zip(bounds, bounds[1:])]
+
+
+class IterJsonArrayTest(unittest.TestCase):
+
+    def test_split_at_every_offset(self):
+        for doc in DOCUMENTS:
+            expected = json.loads(doc.decode("utf-8"))
+            for offset in range(len(doc) + 1):
+                chunks = _split_at(doc, [offset])
+                self.assertEqual(list(iter_json_array(chunks)), expected, chunks)
+
+
+    def test_split_at_every_pair_of_offsets(self):
+        doc = DOCUMENTS[2]
+        expected = json.loads(doc.decode("utf-8"))
+        for first in range(len(doc) + 1):
+            for second in range(first, len(doc) + 1):
+                chunks = _split_at(doc, [first, second])
+                self.assertEqual(list(iter_json_array(chunks)), expected, chunks)
+
+
+    def test_single_bytes(self):
+        for doc in DOCUMENTS:
+            chunks = [doc[i:i + 1] for i in range(len(doc))]
+            self.assertEqual(list(iter_json_array(chunks)), json.loads(doc.decode("utf-8")))
+
+
+    def test_keyed_split_at_every_offset(self):
+        expected = json.loads(KEYED.decode("utf-8"))
+        for offset in range(len(KEYED) + 1):
+            rest = {}
+            items = list(iter_json_array(_split_at(KEYED, [offset]), "snapshots", rest))
+            self.assertEqual(items, expected["snapshots"])
+            self.assertEqual(rest, dict((k, v) for k, v in expected.items() if k != "snapshots"))
+
+
+    def test_random_chunks(self):
+        rand = random.Random(42)
+        for _ in range(200):
+            doc = rand.choice(DOCUMENTS)
+            offsets = [rand.randint(0, len(doc)) for _ in range(rand.randint(1, 6))]
+            self.assertEqual(list(iter_json_array(_split_at(doc, offsets))),
+                             json.loads(doc.decode("utf-8")))
+
+
+    def test_truncated_number_fails(self):
+        with self.assertRaises(ValueError):
+            list(iter_json_array([b'[1.5e', b'']))
+
+
+if __name__ == "__main__":
+    unittest.main()